@@ -1,5 +1,6 @@
 
-import sys, logging
+import os, sys, logging, time, threading, asyncio, functools
+import concurrent.futures
 sys.path.insert(0, '')
 
 from fastapi import FastAPI, HTTPException
@@ -7,8 +8,13 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from astromlp.sdss.helper import Helper
 from astromlp.sdss.predictor import Predictor
+from astromlp.sdss.registry import registry
+from astromlp.sdss.aio import AsyncFetcher
+from astromlp.sdss.cache import MetadataCache
 from astromlp.galaxies import One2One, CherryPicked, Universal
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title = 'astromlp API',  version = 'v0.1')
 app.add_middleware(
     CORSMiddleware,
@@ -21,56 +27,112 @@ app.add_middleware(
 # initial setup
 @app.on_event('startup')
 def _init():
-    global helper, models, pipelines
-    helper = Helper()
+    global helper, models, pipelines, inputs, startup, ready, fetcher, executor
+    start = time.time()
+    ready, startup, inputs = False, {}, {}
+    helper = Helper(cache=MetadataCache(os.environ.get('ASTROMLP_METADATA_CACHE', '/tmp/mysdss-metadata/metadata.sqlite')))
+
+    # remote data is fetched asynchronously, only inference runs on the executor
+    fetcher = AsyncFetcher(helper=helper)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.environ.get('ASTROMLP_INFERENCE_WORKERS', 4)))
+
     models = {
-        'i2r': Predictor('i2r', helper=helper),
-        'f2r': Predictor('f2r', helper=helper),
-        's2r': Predictor('s2r', helper=helper),
-        'ss2r': Predictor('ss2r', helper=helper),
-        'b2r': Predictor('b2r', helper=helper),
-        'w2r': Predictor('w2r', helper=helper),
-        'i2sm': Predictor('i2sm', helper=helper),
-        'f2sm': Predictor('f2sm', helper=helper),
-        's2sm': Predictor('s2sm', helper=helper),
-        'ss2sm': Predictor('ss2sm', helper=helper),
-        'b2sm': Predictor('b2sm', helper=helper),
-        'w2sm': Predictor('w2sm', helper=helper),
-        'i2s': Predictor('i2s', helper=helper),
-        'f2s': Predictor('f2s', helper=helper),
-        's2s': Predictor('s2s', helper=helper),
-        'ss2s': Predictor('ss2s', helper=helper),
-        'b2s': Predictor('b2s', helper=helper),
-        'w2s': Predictor('w2s', helper=helper),
-        'i2g': Predictor('i2g', helper=helper),
-        'f2g': Predictor('f2g', helper=helper),
-        's2g': Predictor('s2g', helper=helper),
-        'ss2g': Predictor('ss2g', helper=helper),
-        'b2g': Predictor('b2g', helper=helper),
-        'w2g': Predictor('w2g', helper=helper),
-        'fSbW2rSM': Predictor('fSbW2rSM', helper=helper),
-        'fSbW2sG': Predictor('fSbW2sG', helper=helper),
-        'iFsSSbW2r': Predictor('iFsSSbW2r', helper=helper),
-        'iFsSSbW2sm': Predictor('iFsSSbW2sm', helper=helper),
-        'iFsSSbW2s': Predictor('iFsSSbW2s', helper=helper),
-        'iFsSSbW2g': Predictor('iFsSSbW2g', helper=helper),
-        'iFsSSbW2rSMsG': Predictor('iFsSSbW2rSMsG', helper=helper)
+        'i2r': Predictor('i2r', helper=helper, compiled=True),
+        'f2r': Predictor('f2r', helper=helper, compiled=True),
+        's2r': Predictor('s2r', helper=helper, compiled=True),
+        'ss2r': Predictor('ss2r', helper=helper, compiled=True),
+        'b2r': Predictor('b2r', helper=helper, compiled=True),
+        'w2r': Predictor('w2r', helper=helper, compiled=True),
+        'i2sm': Predictor('i2sm', helper=helper, compiled=True),
+        'f2sm': Predictor('f2sm', helper=helper, compiled=True),
+        's2sm': Predictor('s2sm', helper=helper, compiled=True),
+        'ss2sm': Predictor('ss2sm', helper=helper, compiled=True),
+        'b2sm': Predictor('b2sm', helper=helper, compiled=True),
+        'w2sm': Predictor('w2sm', helper=helper, compiled=True),
+        'i2s': Predictor('i2s', helper=helper, compiled=True),
+        'f2s': Predictor('f2s', helper=helper, compiled=True),
+        's2s': Predictor('s2s', helper=helper, compiled=True),
+        'ss2s': Predictor('ss2s', helper=helper, compiled=True),
+        'b2s': Predictor('b2s', helper=helper, compiled=True),
+        'w2s': Predictor('w2s', helper=helper, compiled=True),
+        'i2g': Predictor('i2g', helper=helper, compiled=True),
+        'f2g': Predictor('f2g', helper=helper, compiled=True),
+        's2g': Predictor('s2g', helper=helper, compiled=True),
+        'ss2g': Predictor('ss2g', helper=helper, compiled=True),
+        'b2g': Predictor('b2g', helper=helper, compiled=True),
+        'w2g': Predictor('w2g', helper=helper, compiled=True),
+        'fSbW2rSM': Predictor('fSbW2rSM', helper=helper, compiled=True),
+        'fSbW2sG': Predictor('fSbW2sG', helper=helper, compiled=True),
+        'iFsSSbW2r': Predictor('iFsSSbW2r', helper=helper, compiled=True),
+        'iFsSSbW2sm': Predictor('iFsSSbW2sm', helper=helper, compiled=True),
+        'iFsSSbW2s': Predictor('iFsSSbW2s', helper=helper, compiled=True),
+        'iFsSSbW2g': Predictor('iFsSSbW2g', helper=helper, compiled=True),
+        'iFsSSbW2rSMsG': Predictor('iFsSSbW2rSMsG', helper=helper, compiled=True)
     }
 
     pipelines = {
-        'one2one': One2One(helper=helper),
-        'cherryPicked': CherryPicked(helper=helper),
-        'universal': Universal(helper=helper)
+        'one2one': One2One(helper=helper, compiled=True),
+        'cherryPicked': CherryPicked(helper=helper, compiled=True),
+        'universal': Universal(helper=helper, compiled=True)
     }
 
+    threading.Thread(target=_warmup, args=(start,), daemon=True).start()
+
+@app.on_event('shutdown')
+async def _shutdown():
+    await fetcher.close()
+    executor.shutdown(wait=False)
+
+async def _run(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+def _warmup(start):
+    global startup, ready, inputs
+
+    # load all the models needed in parallel
+    paths = [p._model_path for p in models.values()]
+    for pl in pipelines.values():
+        for ps in pl.predictors.values():
+            paths += [p._model_path for p in ps]
+    paths = list(dict.fromkeys([x for x in paths if x is not None]))
+    _times = registry.preload(paths)
+    _skipped = [x for x in paths if x not in _times]
+
+    # trace and warm up the inference functions
+    _start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda p: p.warmup(), models.values()))
+
+    # inputs needed per model and pipeline, resolved here once so that requests do not
+    # look them up, possibly loading a model, on the event loop
+    inputs = dict([(('infer', k), list(p.x)) for k, p in models.items()] + [(('proc', k), list(p.x)) for k, p in pipelines.items()])
+
+    startup = { 'models': dict([(k, round(v, 3)) for k, v in _times.items()]),
+                'skipped': _skipped,
+                'warmup': round(time.time() - _start, 3),
+                'total': round(time.time() - start, 3) }
+    ready = True
+    logger.info(f"Ready in { startup['total'] }s, { len(_times) } models loaded, { len(_skipped) } skipped")
+
+def _check_ready():
+    if not ready:
+        raise HTTPException(status_code=503, detail='Warming up')
+
 @app.get('/')
 def _root():
     return { 'title': app.title, 'version': app.version }
 
 @app.get('/infer/{model}/{objid}')
-def _infer(model, objid):
+async def _infer(model, objid):
     if model in models.keys():
-        data = models[model].predict(objid)
+        _check_ready()
+        predictor, x = models[model], inputs[('infer', model)]
+        obj = await fetcher.get_obj(objid, wise='wise' in x)
+        if obj is None:
+            raise HTTPException(status_code=404, detail='Object not found')
+
+        await fetcher.fetch(obj, x)
+        data = await _run(predictor.predict, objid, obj=obj)
 
         # FIXME
         data['obj']['objid'] = str(data['obj']['objid'])
@@ -80,14 +142,31 @@ def _infer(model, objid):
         raise HTTPException(status_code=404, detail='Model not found')
 
 @app.get('/proc/{pl}/{objid}')
-def _proc(pl, objid):
+async def _proc(pl, objid):
     if pl in pipelines.keys():
-        result = pipelines[pl].process(objid)
+        _check_ready()
+        pipeline, x = pipelines[pl], inputs[('proc', pl)]
+        obj = await fetcher.get_obj(objid, wise='wise' in x)
+        if obj is None:
+            raise HTTPException(status_code=404, detail='Object not found')
+
+        await fetcher.fetch(obj, x)
+        result = await _run(pipeline.process, objid, obj=obj)
 
         return result.to_json()
     else:
         raise HTTPException(status_code=404, detail='Pipeline not found')
 
+@app.get('/startup')
+def _startup():
+    return startup
+
+@app.get('/ready')
+def _ready():
+    _check_ready()
+
+    return { 'ready': True }
+
 @app.get('/random/id')
 def _random_id():
     data = helper.random_id()
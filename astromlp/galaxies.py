@@ -22,14 +22,14 @@ class One2One(MapReducePipeline):
         Returns:
             :code:`PipelineResult`
     """
-    def __init__(self, model_store='./astromlp-models/model_store', helper=None):
+    def __init__(self, model_store='./astromlp-models/model_store', helper=None, **kwargs):
         models = {
             'redshift': ['i2r', 'f2r', 's2r', 'ss2r', 'b2r', 'w2r'],
             'smass': ['i2sm', 'f2sm', 's2sm', 'ss2sm', 'b2sm', 'w2sm'],
             'subclass': ['i2s', 'f2s', 's2s', 'ss2s', 'b2s', 'w2s'],
             'gz2c': ['i2g', 'f2g', 's2g', 'ss2g', 'b2g', 'w2g']
         }
-        MapReducePipeline.__init__(self, models, model_store=model_store, helper=helper)
+        MapReducePipeline.__init__(self, models, model_store=model_store, helper=helper, **kwargs)
 
 class CherryPicked(MapReducePipeline):
     """ Pipeline for processing SDSS galaxy object and a infer a set of properties using an ensemble of models.
@@ -39,14 +39,14 @@ class CherryPicked(MapReducePipeline):
         Returns:
             :code:`PipelineResult`
     """
-    def __init__(self, model_store='./astromlp-models/model_store', helper=None):
+    def __init__(self, model_store='./astromlp-models/model_store', helper=None, **kwargs):
         models = {
             'redshift': ['s2r', 'ss2r', 'iFsSSbW2r'],
             'smass': ['f2sm'],
             'subclass': ['iFsSSbW2s'],
             'gz2c': ['i2g', 'f2g', 'iFsSSbW2g']
         }
-        MapReducePipeline.__init__(self, models, model_store=model_store, helper=helper)
+        MapReducePipeline.__init__(self, models, model_store=model_store, helper=helper, **kwargs)
 
 class Universal(MapReducePipeline):
     """ Pipeline for processing SDSS galaxy object and a infer a set of properties using an ensemble of models.
@@ -56,11 +56,11 @@ class Universal(MapReducePipeline):
         Returns:
             :code:`PipelineResult`
     """
-    def __init__(self, model_store='./astromlp-models/model_store', helper=None):
+    def __init__(self, model_store='./astromlp-models/model_store', helper=None, **kwargs):
         models = {
             'redshift': ['s2r'],
             'smass': ['i2sm'],
             'subclass': ['ss2s'],
             'gz2c': ['f2g']
         }
-        MapReducePipeline.__init__(self, models, model_store=model_store, helper=helper)
\ No newline at end of file
+        MapReducePipeline.__init__(self, models, model_store=model_store, helper=helper, **kwargs)
\ No newline at end of file
@@ -1,5 +1,5 @@
 
-import os, logging, copy, json
+import os, logging, copy, json, threading, time
 import tensorflow as tf
 from statistics import mean
 import numpy as np
@@ -12,6 +12,43 @@ from .sdss.skyserver import SkyServer
 
 logger = logging.getLogger(__name__)
 
+_executor, _executor_lock = None, threading.Lock()
+
+def shared_executor(max_workers=16):
+    """ Return the executor shared by all pipelines in the process, created on first use.
+
+        Args:
+            max_workers (int): maximum number of threads, used when the executor is created, defaults to `16`
+        Returns:
+            a `ThreadPoolExecutor`
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='astromlp')
+
+    return _executor
+
+class FusedEnsemble(tf.keras.Model):
+    """ A single multi-output Keras model running a set of models on shared inputs, each model
+        receives only the inputs it uses.
+
+        Attributes:
+            members (dict): dictionary of models by name
+    """
+    def __init__(self, members):
+        super().__init__()
+        self.names = list(members.keys())
+        self.members = list(members.values())
+
+    def call(self, inputs, training=False):
+        outputs = {}
+        for name, m in zip(self.names, self.members):
+            outputs[name] = m(dict([(x, inputs[x]) for x in m.input_names]), training=training)
+
+        return outputs
+
 class PipelineResult:
     """ Class for storing the result of processing an object using a pipeline for
         processing SDSS galaxy object and a infer a set of properties using an ensemble of models.
@@ -48,14 +85,27 @@ class PipelineResult:
 class MapReducePipeline:
     """ Base class for processing an object using a map-reduce approach.
 
+        All the tasks for an object, fetching each input and running each model, are
+        scheduled on an executor shared by all pipelines, with a limit of concurrent tasks
+        and a timeout per stage (`inputs` and `predict`).
+
         Attributes:
             models (object): dictionary of outputs, and ensemble of models per output
             model_store (str): location of the astromlp-models model store, defaults to `./astromlp-models/model_store`
+            max_workers (int): size of the shared executor, defaults to `16`
+            limits (dict): maximum number of concurrent tasks per stage, defaults to `{ 'inputs': 6, 'predict': 8 }`
+            timeouts (dict): timeout in seconds per stage, defaults to no timeout
+            compiled (bool): run inference using traced functions, defaults to `False`
     """
-    def __init__(self, models, model_store='./astromlp-models/model_store', helper=None):
+    def __init__(self, models, model_store='./astromlp-models/model_store', helper=None, max_workers=16, limits=None, timeouts=None,
+                 compiled=False):
         self.models = models
         self.model_store = model_store
         self.skyserver = SkyServer()
+        self.max_workers = max_workers
+        self.limits = dict(limits) if limits is not None else { 'inputs': 6, 'predict': 8 }
+        self.timeouts = dict(timeouts) if timeouts is not None else {}
+        self._semaphores = dict([(k, threading.BoundedSemaphore(v)) for k, v in self.limits.items()])
 
         if helper:
             self.helper = helper
@@ -71,49 +121,254 @@ class MapReducePipeline:
             for m in self.models[k]:
                 filename = os.path.join(self.model_store, m)
                 if os.path.exists(filename):
-                    predictors.append(Predictor(m, model_store=self.model_store, helper=self.helper))
+                    predictors.append(Predictor(m, model_store=self.model_store, helper=self.helper, compiled=compiled))
                 else:
                     logger.warn(f'Model not found { filename }')
             self.predictors[k] = predictors
 
-    def _get_predict(self, p, k, objid):
-        _output = p.predict(objid, extra=False)['output']
+        self._x, self._assembler = None, None
+        self._fused, self._pinned = None, []
+        self._fuse_lock = threading.Lock()
+
+    @property
+    def x(self):
+        # inputs needed by any of the predictors, assembled once per object
+        if self._x is None:
+            _x = []
+            for k in self.predictors.keys():
+                for p in self.predictors[k]:
+                    _x += [x for x in p.x if x not in _x]
+            self._x = _x
+            self._assembler = Predictor(None, x=self._x, helper=self.helper)
+
+        return self._x
+
+    def _schedule(self, stage, tasks):
+        # run a dictionary of tasks on the shared executor, and return the results of
+        # the tasks completed within the stage timeout; the stage limit is acquired before
+        # submitting each task, so tasks waiting for the limit do not hold executor threads
+        executor = shared_executor(self.max_workers)
+        semaphore = self._semaphores.get(stage)
+        timeout = self.timeouts.get(stage)
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def _remaining():
+            return None if deadline is None else max(0, deadline - time.monotonic())
+
+        futures, skipped = {}, []
+        for k, v in tasks.items():
+            if semaphore is not None and not semaphore.acquire(timeout=_remaining()):
+                skipped.append(k)
+                continue
+            try:
+                f = executor.submit(*v)
+            except Exception:
+                if semaphore is not None:
+                    semaphore.release()
+                raise
+            if semaphore is not None:
+                f.add_done_callback(lambda _: semaphore.release())
+            futures[k] = f
+
+        # tasks not started yet are cancelled, tasks already running cannot be interrupted
+        # and keep counting against the stage limit until they finish
+        done, not_done = concurrent.futures.wait(futures.values(), timeout=_remaining())
+        for f in not_done:
+            f.cancel()
+
+        results = {}
+        for k in skipped:
+            logger.warn(f'Task timeout { stage } { k }')
+        for k, f in futures.items():
+            if f in not_done:
+                logger.warn(f'Task timeout { stage } { k }')
+            elif f.exception() is not None:
+                logger.warn(f'Task failed { stage } { k }: { f.exception() }')
+            else:
+                results[k] = f.result()
+
+        return results
+
+    def _prepare(self, objid, obj=None):
+        if obj is None:
+            obj = self.helper.get_obj(objid, wise='wise' in self.x)
+        if obj is None:
+            return None, {}
+
+        tasks = dict([(x, (self._assembler._input, obj, x, False)) for x in self.x])
+        _input = dict([(x, v[0]) for x, v in self._schedule('inputs', tasks).items() if v[0] is not None])
+
+        return obj, _input
+
+    def _get_predict(self, p, k, obj, _input):
+        _output = p.predict_input(obj, _input)['output']
         idx = p.y.index(k)
 
         return _output[idx]
 
-    def process(self, objid):
+    def _reduce(self, k, values):
+        if len(values) == 0:
+            return None
+
+        if k in CLASSES.keys():
+            return CLASSES[k][np.argmax(np.add.reduce(values))]
+        else:
+            return mean(values)
+
+    def _member(self, p):
+        return os.path.basename(p._model_path) if p._model_path is not None else f'model_{ id(p) }'
+
+    def fuse(self):
+        """ Compile all the models of the pipeline into a single multi-output model that shares
+            the input layers, so that the map step runs a single forward pass. The models used
+            by the fused model are pinned in the registry, so they are kept loaded.
+
+            Returns:
+                a :code:`FusedEnsemble`
+        """
+        members, specs, pinned = {}, {}, []
+        for k in self.predictors.keys():
+            for p in self.predictors[k]:
+                if self._member(p) not in members:
+                    if p._model_path is not None:
+                        model = p.registry.pin(p._model_path)
+                        pinned.append((p.registry, p._model_path))
+                    else:
+                        model = p.model
+                    members[self._member(p)] = model
+                    for n, t in zip(model.input_names, model.inputs):
+                        specs[n] = tf.TensorSpec((None,) + tuple(t.shape[1:]), tf.float32)
+
+        fused = FusedEnsemble(members)
+        fn = tf.function(lambda inputs: fused(inputs, training=False), input_signature=[specs])
+
+        # the fused model and its function are published together, and the models pinned
+        # by a previous fused model are released
+        with self._fuse_lock:
+            self._fused, previous = (fused, fn), self._pinned
+            self._pinned = pinned
+        for registry, path in previous:
+            registry.unpin(path)
+
+        return fused
+
+    def _fused_map(self, fn, obj, _input):
+        outputs = fn(dict([(x, tf.convert_to_tensor(_input[x], tf.float32)) for x in self.x]))
+
+        results = {}
+        for k in self.models.keys():
+            for i, p in enumerate(self.predictors[k]):
+                _output = outputs[self._member(p)]
+                _output = [x.numpy() for x in _output] if isinstance(_output, (list, tuple)) else _output.numpy()
+                results[(k, i)] = p._result(obj, {}, _output, {}, extra=False, return_input=False)['output'][p.y.index(k)]
+
+        return results
+
+    def process(self, objid, obj=None):
+        """ Process a SDSS object.
+
+            Args:
+                objid (int): SDSS object identifier
+                obj: SDSS object, optional if already retrieved
+            Returns:
+                a :code:`PipelineResult`
+        """
         result = { 'objid': objid, 'models': copy.deepcopy(self.models) }
-        result['obj'] = self.skyserver.get_obj(objid, wise=False)
+        obj, _input = self._prepare(objid, obj=obj)
+        result['obj'] = obj
 
         # map
+        fused = self._fused
+        if fused is not None and obj is not None and all(x in _input for x in self.x):
+            results = self._schedule('predict', { 'fused': (self._fused_map, fused[1], obj, _input) }).get('fused', {})
+        else:
+            tasks = {}
+            for k in self.models.keys():
+                for i, p in enumerate(self.predictors[k]):
+                    if obj is not None and all(x in _input for x in p.x):
+                        tasks[(k, i)] = (self._get_predict, p, k, obj, _input)
+            results = self._schedule('predict', tasks)
+
         _map = {}
         for k in self.models.keys():
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                futures = []
-                for p in self.predictors[k]:
-                    futures.append(executor.submit(self._get_predict, p, k, objid))
-
-                    results = [x.result() for x in futures]
-                _map[k] = results
+            _map[k] = [results[(k, i)] for i in range(len(self.predictors[k])) if (k, i) in results]
         result['map'] = _map
 
         # reduce
         _outputs = {}
         for k in result['map'].keys():
-            if k in CLASSES.keys():
-                _outputs[k] = CLASSES[k][np.argmax(np.add.reduce(result['map'][k]))]
-            else:
-                _outputs[k] = mean(result['map'][k])
+            _outputs[k] = self._reduce(k, result['map'][k])
         result['output'] = _outputs
 
         return PipelineResult(result)
 
+    def _predict_many(self, p, k, _input):
+        _output = p.predict_arrays(_input)[k]
+
+        return _output.reshape(len(_output), -1)
 
+    def process_many(self, objids, batch_size=32):
+        """ Process a list of SDSS objects in batches, fetching the inputs for each batch,
+            running each model once per batch and reducing the results for all objects at once.
 
+            Args:
+                objids ([int]): list of SDSS object identifiers
+                batch_size (int): number of objects per batch, defaults to `32`
+            Returns:
+                a generator of :code:`PipelineResult`, in the same order as `objids`
+        """
+        objids = list(objids)
 
+        for start in range(0, len(objids), batch_size):
+            batch = objids[start:start+batch_size]
+            objs = self.helper.get_objs(batch, wise='wise' in self.x)
 
+            # inputs
+            tasks = {}
+            for i, obj in enumerate(objs):
+                if obj is not None:
+                    for x in self.x:
+                        tasks[(i, x)] = (self._assembler._input, obj, x, False)
+            fetched = dict([(k, v[0]) for k, v in self._schedule('inputs', tasks).items() if v[0] is not None])
 
+            # map
+            tasks, members = {}, {}
+            for k in self.models.keys():
+                for j, p in enumerate(self.predictors[k]):
+                    idx = np.array([i for i in range(len(objs)) if all((i, x) in fetched for x in p.x)], dtype=int)
+                    if len(idx) > 0:
+                        _input = dict([(x, np.concatenate([fetched[(i, x)] for i in idx])) for x in p.x])
+                        tasks[(k, j)] = (self._predict_many, p, k, _input)
+                        members[(k, j)] = idx
+            results = self._schedule('predict', tasks)
 
+            # reduce
+            _map, _outputs = [dict() for _ in objs], [dict() for _ in objs]
+            for k in self.models.keys():
+                _members = [(members[(k, j)], results[(k, j)]) for j in range(len(self.predictors[k])) if (k, j) in results]
+                if len(_members) == 0:
+                    for i in range(len(objs)):
+                        _map[i][k], _outputs[i][k] = [], None
+                    continue
+
+                stacked = np.full((len(_members), len(objs), _members[0][1].shape[1]), np.nan)
+                for m, (idx, values) in enumerate(_members):
+                    stacked[m, idx] = values
+                found = ~np.isnan(stacked[:, :, 0])
+                counts = found.sum(axis=0)
+                totals = np.nansum(stacked, axis=0)
+
+                if k in CLASSES.keys():
+                    labels = np.argmax(totals, axis=1)
+                    reduced = [CLASSES[k][c] for c in labels]
+                else:
+                    reduced = (totals[:, 0] / np.maximum(counts, 1)).tolist()
 
+                for i in range(len(objs)):
+                    values = stacked[found[:, i], i]
+                    _map[i][k] = [float(v[0]) if len(v) == 1 else v.tolist() for v in values]
+                    _outputs[i][k] = reduced[i] if counts[i] > 0 else None
 
+            for i, obj in enumerate(objs):
+                yield PipelineResult({ 'objid': batch[i], 'models': copy.deepcopy(self.models), 'obj': obj,
+                                       'map': _map[i], 'output': _outputs[i] })
@@ -0,0 +1,277 @@
+
+import os, logging, asyncio
+from urllib.parse import urlparse
+import httpx
+
+from . import httpclient
+from .helper import Helper, Row
+from .skyserver import SkyServer
+from .cache import atomic_write, get_asset_cache
+from .shared import BANDS
+
+logger = logging.getLogger(__name__)
+
+async def _save(client, url, filename, params=None):
+    # download a file, written atomically so that it is never seen partially written
+    if os.path.exists(filename):
+        return filename
+
+    r = await client.get(url, params=params)
+    if r.status_code != 200:
+        logger.warn(f'Request failed { r.status_code } { url }')
+        return None
+
+    return atomic_write(filename, r.content)
+
+class AsyncHTTPClient:
+    """ Asynchronous version of `HTTPClient`, with the same policy: timeouts, retries with backoff
+        for failed connections and `RETRY_STATUS` responses, a limit of concurrent requests per host
+        and per host rate limits. Settings default to those of the HTTP client shared by the process
+        (see `httpclient.configure`).
+
+        Attributes:
+            max_connections (int): maximum number of concurrent connections, defaults to `32`
+            settings (HTTPClient): client providing the settings, defaults to the HTTP client shared by the process
+    """
+    def __init__(self, max_connections=32, settings=None):
+        """ Constructor method """
+        self.settings = settings if settings is not None else httpclient.get_client()
+
+        timeout = self.settings.timeout
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        self.client = httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=max_connections,
+                                                                              max_keepalive_connections=self.settings.pool_size))
+
+        self._hosts = {}
+
+    async def aclose(self):
+        """ Close the HTTP client. """
+        await self.client.aclose()
+
+    def _host_semaphore(self, host):
+        if host not in self._hosts:
+            self._hosts[host] = asyncio.Semaphore(self.settings.max_per_host)
+
+        return self._hosts[host]
+
+    async def _wait_rate(self, url):
+        # the rate limiters are shared with the synchronous client
+        limiter = self.settings._host_limiter(url)
+        if limiter is None:
+            return
+
+        delay = limiter.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _backoff(self, attempt, r=None):
+        # honour Retry-After when given in seconds, as urllib3 does
+        if r is not None and r.headers.get('Retry-After', '').isdigit():
+            return int(r.headers['Retry-After'])
+
+        return self.settings.backoff * (2 ** attempt)
+
+    async def request(self, method, url, **kwargs):
+        """ Perform a request, retried with backoff on failed connections and `RETRY_STATUS` responses.
+
+            Args:
+                method (str): HTTP method
+                url (str): request URL
+                kwargs: request arguments (eg. `params`, `data`)
+            Returns:
+                a `httpx.Response`
+        """
+        host = urlparse(url).netloc
+
+        for attempt in range(self.settings.retries + 1):
+            await self._wait_rate(url)
+            try:
+                async with self._host_semaphore(host):
+                    r = await self.client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                if attempt == self.settings.retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+
+            if r.status_code not in httpclient.RETRY_STATUS or attempt == self.settings.retries:
+                return r
+            await asyncio.sleep(self._backoff(attempt, r))
+
+    async def get(self, url, params=None):
+        """ Perform a GET request, see `request`. """
+        return await self.request('GET', url, params=params)
+
+    async def post(self, url, data=None):
+        """ Perform a POST request for a read-only query, see `request`. """
+        return await self.request('POST', url, data=data)
+
+class AsyncSkyServer:
+    """ Asynchronous version of the `SkyServer` operations.
+
+        Attributes:
+            client (AsyncHTTPClient): HTTP client
+            skyserver (SkyServer): synchronous SkyServer, for URLs and queries
+    """
+    def __init__(self, client, skyserver=None):
+        """ Constructor method """
+        self.client = client
+        self.skyserver = skyserver if skyserver is not None else SkyServer()
+
+    async def get_obj(self, objid, wise=True):
+        """ Retrieve information for a SDSS object, see `SkyServer.get_obj`. """
+        return (await self.get_objs([objid], wise=wise))[0]
+
+    async def get_objs(self, objids, wise=True, chunk_size=200):
+        """ Retrieve information for a list of SDSS objects, see `SkyServer.get_objs`. """
+        objids = [int(x) for x in objids]
+        _unique = list(dict.fromkeys(objids))
+
+        async def _query(chunk):
+            payload = { 'cmd': self.skyserver._objs_sql(chunk, wise), 'format': 'json' }
+            r = await self.client.post(self.skyserver._url('/SearchTools/SqlSearch'), data=payload)
+            if r.status_code != 200:
+                logger.warn(f'SkyServer request failed { r.status_code }')
+                return {}
+
+            _found = self.skyserver._parse_objs(r.json(), wise)
+            if _found is None:
+                return {}
+            await asyncio.to_thread(self.skyserver._cache_objs, chunk, _found, wise)
+
+            return _found
+
+        # cache lookups may wait for the database lock held by other processes, so they
+        # run in a thread rather than blocking the event loop
+        found = {}
+        if self.skyserver.cache is not None:
+            found = await asyncio.to_thread(self.skyserver.cache.get_many, _unique, wise=wise)
+            _unique = [x for x in _unique if x not in found]
+
+        chunks = [_unique[i:i+chunk_size] for i in range(0, len(_unique), chunk_size)]
+        for result in await asyncio.gather(*[_query(c) for c in chunks]):
+            found.update(result)
+
+        return [found.get(x) for x in objids]
+
+    async def save_jpeg(self, objid, filename, ra, dec, scale=0.2, width=150, height=150):
+        """ Save RGB image in JPEG format for a given SDSS object, see `SkyServer.save_jpeg`. """
+        payload = self.skyserver._jpeg_payload(ra, dec, scale, width, height)
+
+        return await _save(self.client, self.skyserver._url('/ImgCutout/getjpeg'), filename, params=payload)
+
+class AsyncFetcher:
+    """ Fetch asynchronously the remote data needed to run a model for a SDSS object, into the
+        same files used by a `Predictor`, so that only inference is left to run synchronously.
+
+        Attributes:
+            helper (Helper): helper for the `sdss-ds` dataset
+            tmp_dir (str): predictors temporary files directory, defaults to `/tmp/mysdss`
+            max_connections (int): maximum number of concurrent connections, defaults to `32`
+            assets (AssetCache): cache for remote data, defaults to the cache shared by the process in `tmp_dir/assets`
+            settings (HTTPClient): client providing timeouts, retries and per host limits, defaults to
+                the HTTP client shared by the process
+    """
+    def __init__(self, helper=None, tmp_dir='/tmp/mysdss', max_connections=32, assets=None, settings=None):
+        """ Constructor method """
+        self.helper = helper if helper is not None else Helper()
+        self.tmp_dir = tmp_dir
+        self.assets = assets if assets is not None else get_asset_cache(os.path.join(self.tmp_dir, 'assets'))
+
+        self.client = AsyncHTTPClient(max_connections=max_connections, settings=settings)
+        self.ss = AsyncSkyServer(self.client, skyserver=self.helper.ss)
+
+    async def close(self):
+        """ Close the HTTP client. """
+        await self.client.aclose()
+
+    def _tmp_filename(self, objid, suffix):
+        return self.assets.path(f'{ objid }{ suffix }')
+
+    async def _fetch_asset(self, objid, suffix, fetch):
+        # fetch a file into the asset cache on a miss
+        name = f'{ objid }{ suffix }'
+        if self.assets.get(name) is None and await fetch(self.assets.path(name)):
+            self.assets.add(name)
+
+    async def get_obj(self, objid, wise=False):
+        """ Retrieve information for a SDSS object, from the `sdss-ds` dataset if available.
+
+            Args:
+                objid (int): SDSS object identifier
+                wise (bool): include WISE data, defaults to `False`
+            Returns:
+                a `Row`, or `None` if the object is not found
+        """
+        objid = int(objid)
+        if self.helper._positions([objid])[0] >= 0:
+            return self.helper.get_obj(objid, wise=wise)
+
+        obj = await self.ss.get_obj(objid, wise=wise)
+
+        return Row(obj) if obj is not None else None
+
+    async def _fetch_img(self, obj):
+        if self.helper._has_img(obj['objid']):
+            return
+        await self._fetch_asset(obj['objid'], '.jpg', lambda f: self.ss.save_jpeg(obj['objid'], f, obj['ra'], obj['dec']))
+
+    async def _fetch_spectra(self, obj, x):
+        # the spectra data file is also used to build the spectra selected bands
+        _spectra = 'spectra' in x and not os.path.exists(self.helper._spectra_filename(obj['objid']))
+        _ssel = 'ssel' in x and not os.path.exists(self.helper._ssel_filename(obj['objid']))
+        if _spectra or _ssel:
+            await self._fetch_asset(obj['objid'], '_spectra.csv', lambda f: _save(self.client, self.helper._spectra_url(obj), f))
+
+    async def _get(self, url):
+        r = await self.client.get(url)
+        if r.status_code != 200:
+            logger.warn(f'Request failed { r.status_code } { url }')
+            return None
+
+        return r.content
+
+    async def _fetch_frame(self, obj, band):
+        # download a frame into the frames cache shared with the helper
+        cache, name = self.helper._frame_cache(), self.helper._frame_name(obj, band)
+        if cache.get(name) is not None:
+            return True
+
+        content = await self._get(self.helper._frame_url(obj, band))
+        if content is None:
+            return False
+        await asyncio.to_thread(cache.write, name, content)
+
+        return True
+
+    async def _fetch_fits(self, obj):
+        if os.path.exists(self.helper._fits_filename(obj['objid'])):
+            return
+
+        async def _save_fits(filename):
+            # frames are downloaded concurrently, the cutouts run in a thread
+            if not all(await asyncio.gather(*[self._fetch_frame(obj, b) for b in BANDS])):
+                return False
+            data = await asyncio.to_thread(self.helper.save_fits, obj, filename=filename)
+
+            return data is not None
+
+        await self._fetch_asset(obj['objid'], '.npy', _save_fits)
+
+    async def fetch(self, obj, x):
+        """ Fetch the remote data for a SDSS object and a list of input variables.
+
+            Args:
+                obj: SDSS object
+                x ([str]): list of input variables (eg. `img`, `spectra`)
+        """
+        tasks = []
+        if 'img' in x:
+            tasks.append(self._fetch_img(obj))
+        if 'fits' in x:
+            tasks.append(self._fetch_fits(obj))
+        if 'spectra' in x or 'ssel' in x:
+            tasks.append(self._fetch_spectra(obj, x))
+
+        await asyncio.gather(*tasks)
@@ -0,0 +1,268 @@
+
+import os, logging, sqlite3, json, time, threading
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+class MetadataCache:
+    """ A persistent cache for SDSS objects metadata retrieved from SkyServer, stored in a SQLite
+        database that can be shared by several processes. Objects not found are also cached
+        (negative caching), for a shorter period.
+
+        Attributes:
+            filename (str): location of the database file
+            ttl (float): time to live of cached objects in seconds, defaults to 30 days
+            negative_ttl (float): time to live of objects not found in seconds, defaults to 1 day
+    """
+    def __init__(self, filename, ttl=30*86400, negative_ttl=86400):
+        """ Constructor method """
+        self.filename = filename
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+
+        with closing(self._connect()) as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS objs (objid INTEGER, wise INTEGER, data TEXT, created REAL, PRIMARY KEY (objid, wise))')
+
+    def _connect(self):
+        # one connection per operation, so the cache can be used from any thread or process
+        db = sqlite3.connect(self.filename, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+
+        return db
+
+    def get_many(self, objids, wise=False):
+        """ Retrieve cached metadata for a list of SDSS objects.
+
+            Args:
+                objids ([int]): list of SDSS object identifiers
+                wise (bool): metadata including WISE data, defaults to `False`
+            Returns:
+                a dictionary with the cached objects by identifier, `None` for objects cached as not found
+        """
+        objids = [int(x) for x in objids]
+        now = time.time()
+
+        found = {}
+        with closing(self._connect()) as db:
+            for start in range(0, len(objids), 500):
+                chunk = objids[start:start+500]
+                sql = f"SELECT objid, data, created FROM objs WHERE wise = ? AND objid IN ({ ', '.join(['?'] * len(chunk)) })"
+                for objid, data, created in db.execute(sql, [int(wise)] + chunk):
+                    if data is None and now - created <= self.negative_ttl:
+                        found[objid] = None
+                    elif data is not None and now - created <= self.ttl:
+                        found[objid] = json.loads(data)
+
+        return found
+
+    def put_many(self, objs, wise=False):
+        """ Store metadata for a set of SDSS objects.
+
+            Args:
+                objs (dict): objects by identifier, `None` for objects not found
+                wise (bool): metadata including WISE data, defaults to `False`
+        """
+        now = time.time()
+        rows = [(int(k), int(wise), None if v is None else json.dumps(v), now) for k, v in objs.items()]
+
+        with closing(self._connect()) as db, db:
+            db.executemany('INSERT OR REPLACE INTO objs (objid, wise, data, created) VALUES (?, ?, ?, ?)', rows)
+
+    def clear(self):
+        """ Remove all cached metadata. """
+        with closing(self._connect()) as db, db:
+            db.execute('DELETE FROM objs')
+
+def atomic_write(filename, data):
+    """ Write a file atomically, writing to a temporary file first and renaming it, so that
+        readers never see a partially written file.
+
+        Args:
+            filename (str): file location
+            data (bytes): file contents
+        Returns:
+            the filename
+    """
+    tmp = f'{ filename }.{ os.getpid() }.{ threading.get_ident() }.tmp'
+    try:
+        with open(tmp, 'wb') as fout:
+            fout.write(data)
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return filename
+
+class AssetCache:
+    """ A directory of downloaded and derived files (eg. images, spectra, FITS cutouts) with a
+        size budget, the least recently used files are removed when the budget is exceeded.
+        Files are written atomically, and the usage order is kept in the files modification
+        times, so the same directory can be shared by several instances and processes. Every
+        file under the directory is subject to eviction, so it must be dedicated to the cache.
+
+        Attributes:
+            directory (str): location of the cache directory
+            max_bytes (int): size budget in bytes, defaults to no limit
+            low_water (float): fraction of the budget kept after an eviction, defaults to `0.9`
+    """
+    def __init__(self, directory, max_bytes=None, low_water=0.9):
+        """ Constructor method """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+        self._lock = threading.Lock()
+        self._nbytes = None
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, name):
+        """ Location of a file in the cache.
+
+            Args:
+                name (str): file name, relative to the cache directory
+            Returns:
+                the file location
+        """
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        """ Look up a file in the cache, marking it as recently used.
+
+            Args:
+                name (str): file name, relative to the cache directory
+            Returns:
+                the file location, or `None` if the file is not in the cache
+        """
+        filename = self.path(name)
+
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        return filename
+
+    def add(self, name):
+        """ Account for a file written to the cache by other means (eg. atomically by a helper),
+            evicting older files if the budget is exceeded.
+
+            Args:
+                name (str): file name, relative to the cache directory
+            Returns:
+                the file location, or `None` if the file does not exist
+        """
+        filename = self.path(name)
+        if not os.path.exists(filename):
+            return None
+
+        with self._lock:
+            if self._nbytes is not None:
+                self._nbytes += os.path.getsize(filename)
+        self._evict(keep=filename)
+
+        return filename
+
+    def write(self, name, data):
+        """ Write a file to the cache atomically.
+
+            Args:
+                name (str): file name, relative to the cache directory
+                data (bytes): file contents
+            Returns:
+                the file location
+        """
+        filename = self.path(name)
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        atomic_write(filename, data)
+
+        return self.add(name)
+
+    def _scan(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for n in names:
+                if n.endswith('.tmp'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, n))
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime_ns, st.st_size, os.path.join(root, n)))
+
+        return sorted(files)
+
+    def _evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+
+        with self._lock:
+            if self._nbytes is not None and self._nbytes <= self.max_bytes:
+                return
+
+            # the running total is only an estimate when the directory is shared, so
+            # rescan it before evicting the least recently used files
+            files = self._scan()
+            self._nbytes = sum(size for _, size, _ in files)
+            if self._nbytes <= self.max_bytes:
+                return
+
+            for _, size, filename in files:
+                if self._nbytes <= self.max_bytes * self.low_water:
+                    break
+                if filename == keep:
+                    continue
+                try:
+                    os.remove(filename)
+                    self.evictions += 1
+                except FileNotFoundError:
+                    pass
+                self._nbytes -= size
+
+    @property
+    def nbytes(self):
+        """ Size of the files in the cache, in bytes. """
+        return sum(size for _, size, _ in self._scan())
+
+    def stats(self):
+        """ Cache usage counters.
+
+            Returns:
+                a dictionary with the number of hits, misses and evictions
+        """
+        with self._lock:
+            return { 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions }
+
+_asset_caches, _asset_caches_lock = {}, threading.Lock()
+
+def get_asset_cache(directory, max_bytes=None):
+    """ Return the asset cache shared by the process for a directory, created on first use.
+
+        Args:
+            directory (str): location of the cache directory
+            max_bytes (int): size budget in bytes, defaults to the `ASTROMLP_TMP_MAX_BYTES`
+                environment variable, or no limit
+        Returns:
+            an `AssetCache`
+    """
+    key = os.path.abspath(directory)
+
+    with _asset_caches_lock:
+        if key not in _asset_caches:
+            if max_bytes is None and 'ASTROMLP_TMP_MAX_BYTES' in os.environ:
+                max_bytes = int(os.environ['ASTROMLP_TMP_MAX_BYTES'])
+            _asset_caches[key] = AssetCache(directory, max_bytes=max_bytes)
+
+        return _asset_caches[key]
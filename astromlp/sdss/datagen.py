@@ -1,76 +1,242 @@
 
-import os, logging, random
+import os, logging
 import tensorflow as tf
 import numpy as np
+import concurrent.futures
 
 from .helper import Helper
-from .shared import CLASSES, SM_FACTOR
+from .shared import CLASSES, SM_FACTOR, SHAPES
+from .pool import process_pool, worker_state
 
 logger = logging.getLogger(__name__)
 
+def load_batch(helper, ids, x, y, classes=CLASSES):
+    """ Load the inputs and outputs for a batch of SDSS objects.
+
+        Args:
+            helper (Helper): helper used to load the data
+            ids ([int]): list of SDSS object identifiers
+            x ([str]): list of input variables (eg. `img`, `spectra`)
+            y ([str]): list of output variables (eg. `redshift`, `subclass`)
+            classes: classes object
+        Returns:
+            a tuple of dictionaries with the inputs and outputs
+    """
+    X = {}
+    if 'img' in x:
+        X['img'] = helper.load_imgs(ids)
+    if 'fits' in x:
+        X['fits'] = helper.load_fits(ids)
+    if 'spectra' in x:
+        X['spectra'] = helper.load_spectras(ids)
+    if 'ssel' in x:
+        X['ssel'] = helper.load_ssels(ids)
+    if 'bands' in x:
+        X['bands'] = helper.load_bands(ids)
+    if 'wise' in x:
+        X['wise'] = helper.load_wises(ids)
+
+    Y = {}
+    if 'redshift' in y:
+        Y['redshift'] = helper.y_list(ids, 'redshift')
+    if 'subclass' in y:
+        Y['subclass'], _ = helper.y_list_class(ids, 'subclass', classes['subclass'])
+    if 'smass' in y:
+        Y['smass'] = helper.y_list(ids, 'stellarmass') / SM_FACTOR
+    if 'gz2c' in y:
+        Y['gz2c'], _ = helper.y_list_class(ids, 'gz2c', classes['gz2c'])
+
+    return X, Y
+
+def _worker_batch(ids):
+    # runs in a process pool worker, the helper and variables are sent once per worker
+    state = worker_state()
+
+    return load_batch(state['helper'], ids, state['x'], state['y'], state['classes'])
+
 class DataGen(tf.keras.utils.Sequence):
     """ A data generator to use the `SDSS Galaxy Subset <https://zenodo.org/record/6393488>`_ dataset with `Keras <https://keras.io/>`_.
 
+        When `prefetch` is set the next batches are loaded ahead of time by a pool of workers,
+        batches are prefetched in index order so use `shuffle=False` when calling `fit`, the
+        identifiers are shuffled at the end of each epoch.
+
+        The identifiers are iterated using a permutation that is shuffled at the end of each epoch,
+        optionally seeded (seeded runs are also shuffled in the first epoch), and can be sharded
+        across several workers, each worker using only the identifiers in its shard. Shards are
+        truncated to the same length, so the last `len(ids) % num_workers` identifiers are dropped.
+
         Attributes:
             ids (str): list of SDSS object identifiers
             x ([str]): list of input variables (eg. `img`, `spectra`)
             y ([str]): list of output variables (eg. `redshift`, `subclass`)
             batch_size (int): batch size, defaults to `64`
+            seed (int): seed for shuffling the identifiers, defaults to `None`
+            drop_last (bool): drop the last batch if incomplete, defaults to `True`
+            worker_index (int): index of this worker's shard, defaults to `0`
+            num_workers (int): number of shards, defaults to `1`
+            prefetch (int): number of batches to load ahead of time, defaults to `0` (no prefetching)
+            workers (int): number of prefetching workers, defaults to `4`
+            use_processes (bool): use a pool of processes instead of threads, defaults to `False`
     """
-    def __init__(self, ids, x=[], y=[], classes=CLASSES, batch_size=64, helper=None):
+    def __init__(self, ids, x=[], y=[], classes=CLASSES, batch_size=64, helper=None, prefetch=0, workers=4, use_processes=False,
+                 seed=None, drop_last=True, worker_index=0, num_workers=1):
+        if not 0 <= worker_index < num_workers:
+            raise ValueError(f'Invalid worker index { worker_index } for { num_workers } workers')
+
+        # every shard has the same length, so all workers run the same number of steps
+        ids = np.asarray(ids)
         self.batch_size = batch_size
-        self.ids = ids
+        self.ids = ids[worker_index::num_workers][:len(ids) // num_workers]
         self.x = x
         self.y = y
         self.classes = classes
-        
+        self.prefetch = prefetch
+        self.workers = workers
+        self.use_processes = use_processes
+        self.seed = seed
+        self.drop_last = drop_last
+        self.worker_index = worker_index
+        self.num_workers = num_workers
+
+        self.epoch = 0
+        self._perm = self._permutation()
+
         if helper is None:
             self.helper = Helper()
         else:
             self.helper = helper
 
-    def __getitem__(self, index):
+        self._executor = None
+        self._futures = {}
+
+    def _batch_ids(self, index):
         _from, _to = index*self.batch_size, (index+1)*self.batch_size
-        _ids = self.ids[_from:_to]
-        _y = self.y[_from:_to]
-
-        X = {}
-        if 'img' in self.x:
-            X['img'] = self.helper.load_imgs(_ids)
-        if 'fits' in self.x:
-            X['fits'] = self.helper.load_fits(_ids)
-        if 'spectra' in self.x:
-            X['spectra'] = self.helper.load_spectras(_ids)
-        if 'ssel' in self.x:
-            X['ssel'] = self.helper.load_ssels(_ids)
-        if 'bands' in self.x:
-            X['bands'] = self.helper.load_bands(_ids)
-        if 'wise' in self.x:
-            X['wise'] = self.helper.load_wises(_ids)
-
-        y = {}
-        if 'redshift' in self.y:
-            y['redshift'] = np.array(self.helper.y_list(_ids, 'redshift'))
-        if 'subclass' in self.y:
-            _y, _classes = self.helper.y_list_class(_ids, 'subclass', self.classes['subclass'])
-            y['subclass'] = np.array(_y)
-        if 'smass' in self.y:
-            y['smass'] = np.array(self.helper.y_list(_ids, 'stellarmass')) / SM_FACTOR
-        if 'gz2c' in self.y:
-            _y, _classes = self.helper.y_list_class(_ids, 'gz2c', self.classes['gz2c'])
-            y['gz2c'] = np.array(_y)
-
-        return X, y
 
-    def __len__(self):
-        return int(np.floor(len(self.ids) / self.batch_size))
+        return self.ids[self._perm[_from:_to]]
 
-    def on_epoch_end(self):
-        random.shuffle(self.ids)
+    def _load(self, index):
+        return load_batch(self.helper, self._batch_ids(index), self.x, self.y, self.classes)
+
+    def _submit(self, index):
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = process_pool(self.workers, helper=self.helper, x=self.x, y=self.y, classes=self.classes)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+        if self.use_processes:
+            return self._executor.submit(_worker_batch, self._batch_ids(index))
+        else:
+            return self._executor.submit(self._load, index)
 
+    def __getitem__(self, index):
+        if self.prefetch <= 0:
+            return self._load(index)
 
+        # keep at most `prefetch` batches ahead of the current one in flight
+        for i in list(self._futures.keys()):
+            if i < index or i > index + self.prefetch:
+                self._futures.pop(i).cancel()
+        for i in range(index, min(index + self.prefetch + 1, len(self))):
+            if i not in self._futures:
+                self._futures[i] = self._submit(i)
 
+        if index in self._futures:
+            return self._futures.pop(index).result()
 
+        return self._load(index)
 
+    def __len__(self):
+        if self.drop_last:
+            return int(np.floor(len(self.ids) / self.batch_size))
+        else:
+            return int(np.ceil(len(self.ids) / self.batch_size))
 
+    def _cancel(self):
+        for f in self._futures.values():
+            f.cancel()
+        self._futures = {}
 
+    def on_epoch_end(self):
+        self._cancel()
+
+        self.epoch += 1
+        self._perm = self._permutation()
+
+    def _permutation(self):
+        # the first epoch is only shuffled when seeded, to keep the given order otherwise
+        if self.seed is None:
+            if self.epoch == 0:
+                return np.arange(len(self.ids))
+            return np.random.default_rng().permutation(len(self.ids))
+
+        return np.random.default_rng([self.seed, self.epoch]).permutation(len(self.ids))
+
+    def to_dataset(self, shuffle=True, cache=None, num_parallel_calls=tf.data.AUTOTUNE):
+        """ Build a `tf.data.Dataset` pipeline for the same identifiers, inputs and outputs.
+
+            Batches are loaded by parallel calls, RGB images are decoded by TensorFlow when the
+            decoded images store is not available, and batches are prefetched with autotuning.
+
+            Args:
+                shuffle (bool): shuffle the data on each iteration, defaults to `True`
+                cache (str): cache batches after the first iteration, `'memory'` or a filename, defaults to `None`
+                num_parallel_calls (int): number of batches loaded in parallel, defaults to autotuning
+            Returns:
+                a `tf.data.Dataset` of inputs and outputs dictionaries
+        """
+        _native_img = 'img' in self.x and self.helper._store('img') is None
+        _x = [k for k in SHAPES.keys() if k in self.x and not (k == 'img' and _native_img)]
+        _y = [k for k in SHAPES.keys() if k in self.y]
+        _names = _x + _y
+
+        def _load(ids):
+            X, Y = load_batch(self.helper, ids.tolist(), _x, _y, self.classes)
+            XY = { **X, **Y }
+
+            return [np.asarray(XY[k], dtype=np.float32) for k in _names]
+
+        def _decode_img(objid):
+            filename = tf.strings.join([os.path.join(self.helper.ds, 'img', ''), tf.strings.as_string(objid), '.jpg'])
+            img = tf.io.decode_jpeg(tf.io.read_file(filename), channels=3, dct_method='INTEGER_ACCURATE')
+
+            return tf.cast(img, tf.float32) / 255
+
+        def _map(ids):
+            arrays = tf.numpy_function(_load, [ids], [tf.float32] * len(_names)) if _names else []
+            for a, k in zip(arrays, _names):
+                a.set_shape((None,) + SHAPES[k])
+
+            X, Y = dict(zip(_x, arrays[:len(_x)])), dict(zip(_y, arrays[len(_x):]))
+            if _native_img:
+                X['img'] = tf.map_fn(_decode_img, ids, fn_output_signature=tf.TensorSpec(SHAPES['img'], tf.float32))
+
+            return X, Y
+
+        ds = tf.data.Dataset.from_tensor_slices(np.asarray(self.ids, dtype=np.int64))
+        if shuffle and cache is None:
+            ds = ds.shuffle(len(self.ids), seed=self.seed, reshuffle_each_iteration=True)
+        ds = ds.batch(self.batch_size, drop_remainder=self.drop_last)
+        ds = ds.map(_map, num_parallel_calls=num_parallel_calls, deterministic=True)
+
+        if cache is not None:
+            # batches are cached once, so shuffle the batches order instead
+            ds = ds.cache('' if cache == 'memory' else cache)
+            if shuffle:
+                ds = ds.shuffle(len(self), seed=self.seed, reshuffle_each_iteration=True)
+
+        return ds.prefetch(tf.data.AUTOTUNE)
+
+    def close(self):
+        """ Stop the prefetching workers. """
+        self._cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -1,16 +1,43 @@
 
-import os, random, logging, requests, subprocess, tempfile
+import os, io, bz2, random, logging
 import numpy as np
-from pandas import read_csv, concat
+from pandas import read_csv, concat, Index
 from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.nddata import Cutout2D
+from astropy.coordinates import SkyCoord
 import tensorflow.keras.preprocessing.image as keras
-from ImageCutter.ImageCutter import FITSImageCutter
 import concurrent.futures
 
 from .skyserver import SkyServer
+from . import httpclient
+from .store import ArrayStore
+from . import manifest
+from .cache import atomic_write, get_asset_cache
+from .shared import BANDS
 
 logger = logging.getLogger(__name__)
 
+_WISE_COLUMNS = ['w1mag', 'w2mag', 'w3mag', 'w4mag']
+
+class Row(dict):
+    """ Lightweight row for a SDSS object, a `dict` that also provides attribute access
+        to its proprieties (eg. `row['redshift']` or `row.redshift`).
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+def _img_to_float(x):
+    return x.astype(np.float32) / 255
+
+def _fits_to_float(x):
+    return x.astype(np.float32, copy=False)
+
 class Helper:
     """ A helper class providing set of helper functions to deal with the
         `SDSS Galaxy Subset <https://zenodo.org/record/6501642>`_ dataset,
@@ -18,10 +45,21 @@ class Helper:
 
         Attributes:
             ds (str): location of the `sdss-ds` dataset, detauls to `'../sdss-gs'`
+            cache (MetadataCache): persistent cache for objects not in the `sdss-ds`, optional
+            frames_dir (str): location of the SDSS frames cache, defaults to the `ASTROMLP_FRAMES_DIR`
+                environment variable, or `/tmp/mysdss-frames`
+            frames_max_bytes (int): size budget of the frames cache in bytes, defaults to the
+                `ASTROMLP_FRAMES_MAX_BYTES` environment variable, or 4 GB
+            frames_url (str): SDSS frames base URL, defaults to the `ASTROMLP_FRAMES_URL` environment variable, or the DR17 SAS
+            spectra_url (str): SDSS spectra base URL, defaults to the `ASTROMLP_SPECTRA_URL` environment variable, or DR16
     """
-    def __init__(self, ds: str ='../sdss-gs'):
+    def __init__(self, ds: str ='../sdss-gs', cache=None, frames_dir=None, frames_max_bytes=None, frames_url=None, spectra_url=None):
         """ Constructor method """
         self.ds = ds
+        self.frames_dir = frames_dir or os.environ.get('ASTROMLP_FRAMES_DIR', '/tmp/mysdss-frames')
+        self.frames_max_bytes = frames_max_bytes or int(os.environ.get('ASTROMLP_FRAMES_MAX_BYTES', 4 * 1024**3))
+        self.frames_url = frames_url or os.environ.get('ASTROMLP_FRAMES_URL', 'https://dr17.sdss.org/sas/dr17/eboss/photoObj/frames')
+        self.spectra_url = spectra_url or os.environ.get('ASTROMLP_SPECTRA_URL', 'https://dr16.sdss.org/optical/spectrum/view/data/format=csv/spec=lite')
 
         if not os.path.exists(self.ds):
             logger.warn(f'Dataset files directory not found: { self.ds }')
@@ -32,8 +70,42 @@ class Helper:
             self.df = read_csv(_filename)
         else:
             logger.warn(f'Data file not found: { _filename }')
+        self._build_index()
+        self._stores = {}
+        self._manifest = None
+
+        self.ss = SkyServer(cache=cache)
+
+    def __getstate__(self):
+        # memory-mapped stores are reopened lazily rather than pickled, eg. when
+        # sending the helper to a pool of processes
+        state = self.__dict__.copy()
+        state['_stores'] = {}
+
+        return state
+
+    def _build_index(self):
+        # objid index and row values, built once so lookups do not scan the catalog
+        self._index, self._first, self._columns, self._values = None, None, [], None
+
+        if self.df is not None:
+            self._first = np.flatnonzero(~self.df['objid'].duplicated().to_numpy())
+            self._index = Index(self.df['objid'].to_numpy()[self._first])
+            self._columns = self.df.columns.tolist()
+            self._values = self.df.astype(object).where(self.df.notna(), None).to_numpy()
+
+    def _positions(self, ids):
+        # row positions in the catalog for a list of identifiers, -1 if not found
+        ids = np.asarray(ids).astype(np.int64)
+        if self._index is None or len(self._index) == 0:
+            return np.full(len(ids), -1)
+
+        idx = self._index.get_indexer(ids)
+
+        return np.where(idx >= 0, self._first[idx], -1)
 
-        self.ss = SkyServer()
+    def _row(self, pos):
+        return Row(zip(self._columns, self._values[pos]))
 
     def ids_list(self, has_img=False, has_fits=False, has_spectra=False, has_ssel=False, has_bands=False, has_wise=False, has_gz2c=False):
         """ Build a list of SDSS objects identifiers from the `sdss-ds` dataset.
@@ -47,6 +119,10 @@ class Helper:
                 has_wise (bool): include identifier only if WISE data is available, defaults to `False`
             Returns:
                 list of SDSS objects identifiers
+
+            Files availability is read from the manifest when it has been built (see `build_manifest`),
+            files whose size or modification time changed since are checked individually, as is every
+            file when there is no manifest.
         """
         _df = self.df.copy()
 
@@ -56,6 +132,26 @@ class Helper:
             _df = _df[~_df['w1mag'].isna() & ~_df['w2mag'].isna() & ~_df['w3mag'].isna() & ~_df['w4mag'].isna()]
         if has_gz2c:
             _df = _df[~_df['gz2c_f'].isna() & ~_df['gz2c_s'].isna()]
+
+        _flags = { 'img': has_img, 'fits': has_fits, 'spectra': has_spectra, 'ssel': has_ssel }
+        _checks = { 'img': self._has_img, 'fits': self._has_fits, 'spectra': self._has_spectra, 'ssel': self._has_ssel }
+        _manifest = self.manifest()
+
+        if _manifest is not None:
+            _ids = _df['objid'].to_numpy(dtype=np.int64)
+            pos = Index(_manifest['objid']).get_indexer(_ids)
+            keep = np.ones(len(_ids), dtype=bool)
+            for m, flag in _flags.items():
+                if flag:
+                    available = np.where(pos >= 0, _manifest[f'has_{ m }'].to_numpy(dtype=bool)[pos], False)
+                    changed = manifest.changed(_manifest, m, _ids, [self._filename(m, x) for x in _ids])
+                    if changed.any():
+                        logger.warn(f'Manifest is stale for { changed.sum() } { m } files, checking them individually, run `build_manifest` to update it')
+                        available[changed] = [_checks[m](x) for x in _ids[changed]]
+                    keep &= available
+
+            return _df[keep]['objid'].tolist()
+
         _ids = _df['objid'].tolist()
 
         if has_img:
@@ -69,6 +165,39 @@ class Helper:
 
         return _ids
 
+    def _manifest_filename(self):
+        return os.path.join(self.ds, 'manifest.csv')
+
+    def manifest(self):
+        """ Return the manifest of data available per object in the `sdss-ds` dataset, loaded
+            from the `manifest.csv` file next to `data.csv`.
+
+            Returns:
+                a `DataFrame`, or `None` if the manifest has not been built
+        """
+        if self._manifest is None:
+            self._manifest = manifest.load_manifest(self._manifest_filename())
+
+        return self._manifest
+
+    def build_manifest(self, workers=None):
+        """ Build or update the manifest of data available per object in the `sdss-ds` dataset,
+            only files that changed since the last build are validated again.
+
+            Args:
+                workers (int): number of processes used to validate files, defaults to the number of CPUs
+            Returns:
+                a `DataFrame`
+        """
+        _ids = self.df['objid'].drop_duplicates().tolist()
+        filenames = dict([(m, [self._filename(m, x) for x in _ids]) for m in manifest.MODALITIES])
+
+        previous = manifest.load_manifest(self._manifest_filename())
+        self._manifest = manifest.build_manifest(_ids, filenames, previous=previous, workers=workers)
+        manifest.save_manifest(self._manifest, self._manifest_filename())
+
+        return self._manifest
+
     def _has_img(self, _id):
         return os.path.exists(self._img_filename(_id))
 
@@ -76,24 +205,47 @@ class Helper:
         return os.path.exists(self._fits_filename(_id))
 
     def _has_spectra(self, _id):
-        filename = self._spectra_filename(_id)
-        if os.path.exists(filename):
-            _df = read_csv(filename)
-            if len(_df)>0 and 'Wavelength' in _df.columns and 'BestFit' in _df.columns:
-                _x = _df[(_df['Wavelength']>=4000) & (_df['Wavelength']<=9000.0)]['BestFit'].to_numpy()
-                if len(_x) == 3522:
-                    return True
-        return False
+        return manifest.valid_spectra(self._spectra_filename(_id))
 
     def _has_ssel(self, _id):
-        filename = self._ssel_filename(_id)
-        if os.path.exists(filename):
-            _df = read_csv(filename)
-            _x = _df['BestFit'].to_numpy()
-            if _x.shape == (1423,):
-                return True
+        return manifest.valid_ssel(self._ssel_filename(_id))
+
+    def _store_dir(self, name, DIR='store'):
+        return os.path.join(self.ds, DIR, name)
+
+    def _store(self, name):
+        # packed store for a data type, opened once and `None` if not built
+        if name not in self._stores:
+            path = self._store_dir(name)
+            self._stores[name] = ArrayStore(path) if ArrayStore.exists(path) else None
+
+        return self._stores[name]
+
+    def _load_many(self, name, ids, load, convert=None):
+        # load data for a list of identifiers from the packed store, or file by file
+        # using `load` for objects not available in the store, `convert` is applied
+        # to the data read from the store
+        store = self._store(name)
+        if store is None:
+            return np.array([load(i) for i in ids])
+
+        positions = store.positions(ids)
+        found = positions >= 0
+        _stored = store.take(positions[found])
+        if convert is not None:
+            _stored = convert(_stored)
+        if found.all():
+            return _stored
 
-        return False
+        X = np.empty((len(positions),) + _stored.shape[1:], dtype=_stored.dtype)
+        X[found] = _stored
+        for i in np.flatnonzero(~found):
+            X[i] = load(ids[i])
+
+        return X
+
+    def _filename(self, modality, objID):
+        return getattr(self, f'_{ modality }_filename')(objID)
 
     def _img_filename(self, objID, DIR='img'):
         return os.path.join(self.ds, DIR, str(objID)+'.jpg')
@@ -115,16 +267,51 @@ class Helper:
             Returns:
                 a `Dict` containing proprieties available for the object from the `sdss-ds`
         """
-        if isinstance(id, str):
-            id = int(id)
+        return self.get_objs([id], wise=wise)[0]
 
-        if self.df is not None:
-            sl = self.df[self.df['objid'] == id]
+    def get_objs(self, ids, wise=False):
+        """ Retrieve information for a list of SDSS objects.
 
-        if self.df is None or sl.empty:
-            return self.ss.get_obj(id, wise=wise)
-        else:
-            return sl.replace({np.nan: None}).iloc[0].to_dict()
+            Args:
+                ids ([int]): list of SDSS object identifiers
+                wise (bool): include WISE data for objects not in the `sdss-ds`, defaults to `False`
+            Returns:
+                a list of `Row` objects containing proprieties available for each object, in the same order as `ids`
+        """
+        ids = [int(x) for x in ids]
+        positions = self._positions(ids)
+
+        rows = [self._row(pos) if pos >= 0 else None for pos in positions]
+
+        missing = np.flatnonzero(positions < 0)
+        if len(missing) > 0:
+            objs = self.ss.get_objs([ids[i] for i in missing], wise=wise)
+            for i, obj in zip(missing, objs):
+                rows[i] = Row(obj) if obj is not None else None
+
+        return rows
+
+    def _column_values(self, ids, columns, dtype=np.float64):
+        # gather a set of columns for a list of identifiers into a single numpy array
+        positions = self._positions(ids)
+        found = positions >= 0
+
+        X = np.empty((len(positions), len(columns)), dtype=dtype)
+        if self.df is not None and found.any():
+            for j, c in enumerate(columns):
+                X[found, j] = self.df[c].to_numpy()[positions[found]]
+
+        missing = np.flatnonzero(~found)
+        if len(missing) > 0:
+            wise = any(c in _WISE_COLUMNS for c in columns)
+            rows = self.get_objs([ids[i] for i in missing], wise=wise)
+            for i, row in zip(missing, rows):
+                if row is None:
+                    X[i] = np.nan
+                else:
+                    X[i] = [np.nan if row.get(c) is None else row[c] for c in columns]
+
+        return X
 
     def y_list(self, ids, target):
         """ Build a list of target data to use in the data generator for a continuous variable.
@@ -136,12 +323,7 @@ class Helper:
                 a numpy array
         """
         if target in ['redshift', 'stellarmass']:
-            res = []
-            for i in ids:
-                row = self.get_obj(i)
-                res.append(row[target])
-
-            return res
+            return self._column_values(ids, [target])[:, 0]
 
     def y_list_class(self, ids, target, classes):
         """ Build a list of target data to use in the data generator for a class variable.
@@ -153,18 +335,16 @@ class Helper:
             Returns:
                 a numpy array, class set
         """
-        n = len(classes)
+        if target == 'gz2c':     # exception for gz2class
+            target = 'gz2c_s'
 
-        y = []
-        for i in ids:
-            _row = self.get_obj(i)
-            if target == 'gz2c':     # exception for gz2class
-                c = _row['gz2c_s']
-            else:
-                c = _row[target]
-            tmp = np.zeros(n)
-            tmp[classes.index(c)] = 1
-            y.append(tmp)
+        values = self._column_values(ids, [target], dtype=object)[:, 0]
+        codes = Index(classes).get_indexer(values)
+        if (codes < 0).any():
+            raise ValueError(f'Unknown class for { target }: { values[codes < 0][0] }')
+
+        y = np.zeros((len(codes), len(classes)))
+        y[np.arange(len(codes)), codes] = 1
 
         return y, classes
 
@@ -182,37 +362,71 @@ class Helper:
         return x
 
     def load_imgs(self, _ids):
-        """ Load list of RGB images into a numpy array given list of SDSS object identifiers.
+        """ Load list of RGB images into a numpy array given list of SDSS object identifiers,
+            using the decoded images store when available.
 
             Args:
                 ids ([int]): list of SDSS object identifiers
             Returns:
                 a numpy array
         """
-        X_img = []
+        return self._load_many('img', _ids, lambda i: self.load_img(self._img_filename(i)), convert=_img_to_float)
 
-        for i in _ids:
+    def build_img_store(self, ids=None, workers=8):
+        """ Decode RGB image files into a memory-mapped store of `uint8` arrays, to avoid
+            decoding JPEG files when loading data.
+
+            Args:
+                ids ([int]): list of SDSS object identifiers, defaults to all objects in the `sdss-ds`
+                workers (int): number of threads used to decode the files, defaults to `8`
+            Returns:
+                an `ArrayStore`
+        """
+        if ids is None:
+            ids = self.df['objid'].tolist()
+
+        def _load(i):
             filename = self._img_filename(i)
-            X_img.append(self.load_img(filename))
+            if os.path.exists(filename):
+                return keras.img_to_array(keras.load_img(filename), dtype='uint8')
+
+        self._stores['img'] = ArrayStore.build(self._store_dir('img'), ids, _load, (150, 150, 3), dtype=np.uint8, workers=workers)
 
-        return np.array(X_img)
+        return self._stores['img']
 
     def load_fits(self, _ids):
-        """ Load list of FITS data into a numpy array given list of SDSS object identifiers.
+        """ Load list of FITS data into a numpy array given list of SDSS object identifiers,
+            using the FITS data store when available.
 
             Args:
                 ids ([int]): list of SDSS object identifiers
             Returns:
                 a numpy array
         """
-        X_fits = []
+        return self._load_many('fits', _ids, lambda i: np.load(self._fits_filename(i)), convert=_fits_to_float)
+
+    def build_fits_store(self, ids=None, dtype=np.float32, workers=8):
+        """ Pack FITS data files into a single memory-mapped store, to avoid opening one file
+            per object when loading data.
+
+            Args:
+                ids ([int]): list of SDSS object identifiers, defaults to all objects in the `sdss-ds`
+                dtype: data type for the store, `float32` (default) or `float16` for a store half the size
+                workers (int): number of threads used to read the files, defaults to `8`
+            Returns:
+                an `ArrayStore`
+        """
+        if ids is None:
+            ids = self.df['objid'].tolist()
 
-        for i in _ids:
+        def _load(i):
             filename = self._fits_filename(i)
-            with open(filename, 'rb') as fin:
-                X_fits.append(np.load(fin))
+            if os.path.exists(filename):
+                return np.load(filename)
+
+        self._stores['fits'] = ArrayStore.build(self._store_dir('fits'), ids, _load, (61, 61, 5), dtype=dtype, workers=workers)
 
-        return np.array(X_fits)
+        return self._stores['fits']
 
     def load_spectra(self, filename):
         """ Load spectra data into a numpy array from file.
@@ -234,21 +448,47 @@ class Helper:
         return None
 
     def load_spectras(self, ids):
-        """ Load list of spectra data into a numpy array given list of SDSS object identifiers.
+        """ Load list of spectra data into a numpy array given list of SDSS object identifiers,
+            using the packed spectra store when available.
 
             Args:
                 ids ([int]): list of SDSS object identifiers
             Returns:
                 a numpy array
         """
-        X_spectra = []
+        return self._load_many('spectra', ids, lambda i: self.load_spectra(self._spectra_filename(i))[0])
 
+    def build_spectra_store(self, ids=None, workers=8):
+        """ Pack spectra data files into a memory-mapped store of fixed-width `float32` arrays,
+            with a shared wavelength grid, to avoid parsing CSV files when loading data.
+
+            Args:
+                ids ([int]): list of SDSS object identifiers, defaults to all objects in the `sdss-ds`
+                workers (int): number of threads used to parse the files, defaults to `8`
+            Returns:
+                an `ArrayStore`
+        """
+        if ids is None:
+            ids = self.df['objid'].tolist()
+
+        waves = None
         for i in ids:
-            x, _ = self.load_spectra(self._spectra_filename(i))
-            if x is not None:
-                X_spectra.append(x)
+            _spectra = self.load_spectra(self._spectra_filename(i))
+            if _spectra is not None:
+                waves = _spectra[1]
+                break
+        if waves is None:
+            logger.warn('No spectra data files found')
+            return None
+
+        def _load(i):
+            _spectra = self.load_spectra(self._spectra_filename(i))
+            if _spectra is not None and np.allclose(_spectra[1], waves):
+                return _spectra[0]
 
-        return np.array(X_spectra)
+        self._stores['spectra'] = ArrayStore.build(self._store_dir('spectra'), ids, _load, (3522,), aux={ 'waves': waves }, workers=workers)
+
+        return self._stores['spectra']
 
     def load_ssel(self, filename):
         """ Load spectra selected bands data into a numpy array from file.
@@ -267,21 +507,47 @@ class Helper:
         return None
 
     def load_ssels(self, ids):
-        """ Load list of spectra selected bands data into a numpy array given list of SDSS object identifiers.
+        """ Load list of spectra selected bands data into a numpy array given list of SDSS object identifiers,
+            using the packed ssel store when available.
 
             Args:
                 ids ([int]): list of SDSS object identifiers
             Returns:
                 a numpy array
         """
-        X_ssel = []
+        return self._load_many('ssel', ids, lambda i: self.load_ssel(self._ssel_filename(i))[0])
+
+    def build_ssel_store(self, ids=None, workers=8):
+        """ Pack spectra selected bands data files into a memory-mapped store of fixed-width `float32` arrays,
+            with a shared wavelength grid, to avoid parsing CSV files when loading data.
+
+            Args:
+                ids ([int]): list of SDSS object identifiers, defaults to all objects in the `sdss-ds`
+                workers (int): number of threads used to parse the files, defaults to `8`
+            Returns:
+                an `ArrayStore`
+        """
+        if ids is None:
+            ids = self.df['objid'].tolist()
 
+        waves = None
         for i in ids:
-            x, _ = self.load_ssel(self._ssel_filename(i))
-            if x is not None:
-                X_ssel.append(x)
+            _ssel = self.load_ssel(self._ssel_filename(i))
+            if _ssel is not None and _ssel[0].shape == (1423,):
+                waves = _ssel[1]
+                break
+        if waves is None:
+            logger.warn('No spectra selected bands data files found')
+            return None
+
+        def _load(i):
+            _ssel = self.load_ssel(self._ssel_filename(i))
+            if _ssel is not None and _ssel[1].shape == waves.shape and np.allclose(_ssel[1], waves):
+                return _ssel[0]
 
-        return np.array(X_ssel)
+        self._stores['ssel'] = ArrayStore.build(self._store_dir('ssel'), ids, _load, (1423,), aux={ 'waves': waves }, workers=workers)
+
+        return self._stores['ssel']
 
     def load_bands(self, _ids):
         """ Load list of bands data into a numpy array given list of SDSS object identifiers.
@@ -291,14 +557,7 @@ class Helper:
             Returns:
                 a numpy array
         """
-        X_bands = []
-
-        for i in _ids:
-            row = self.get_obj(i)
-            x = [row['modelMag_u'], row['modelMag_g'], row['modelMag_r'], row['modelMag_i'], row['modelMag_z']]
-            X_bands.append(x)
-
-        return np.array(X_bands)
+        return self._column_values(_ids, ['modelMag_u', 'modelMag_g', 'modelMag_r', 'modelMag_i', 'modelMag_z'])
 
     def load_wises(self, _ids):
         """ Load list of WISE data into a numpy array given list of SDSS object identifiers.
@@ -308,14 +567,7 @@ class Helper:
             Returns:
                 a numpy array
         """
-        X_wise = []
-
-        for i in _ids:
-            row = self.get_obj(i)
-            x = [row['w1mag'], row['w2mag'], row['w3mag'], row['w4mag']]
-            X_wise.append(x)
-
-        return np.array(X_wise)
+        return self._column_values(_ids, _WISE_COLUMNS)
 
     def random_id(self):
         """ Return a random SDSS object identifier from the `sdss-ds` dataset.
@@ -327,31 +579,6 @@ class Helper:
 
         return random.choice(_ids)
 
-    def _frame_url(self, obj, band):
-        return f"https://dr17.sdss.org/sas/dr17/eboss/photoObj/frames/{ obj['rerun'] }/{ obj['run'] }/{ obj['camcol'] }/frame-{ band }-{ str(obj['run']).zfill(6) }-{ obj['camcol'] }-{ str(obj['field']).zfill(4) }.fits.bz2"
-
-    def _frame_filename(self, obj, band, base_dir, DIR='frames', bz=False):
-        d = os.path.join(base_dir, DIR)
-        os.makedirs(d, exist_ok=True)
-        filename = os.path.join(d, str(obj['objid']) + '_' + band + '.fits')
-        
-        if bz:
-            filename += '.bz2'
-
-        return filename
-
-    def _frames_urls_filenames(self, obj, base_dir='./'):
-        r = []
-
-        if obj:
-            for b in ['u', 'g', 'r', 'i', 'z']:
-                u = self._frame_url(obj, b)
-                f = self._frame_filename(obj, b, base_dir, bz=True)
-
-                r.append((u, f))
-
-        return r
-
     def save_img(self, obj, filename=None):
         """ Retrieve and save RGB image for a given SDSS object.
 
@@ -369,21 +596,79 @@ class Helper:
 
         return self.ss.save_jpeg(obj['objid'], filename, ra=obj['ra'], dec=obj['dec'], scale=0.2, width=150, height=150)
 
-    def _save_frame(self, url, filename):
-        if os.path.exists(filename) or os.path.exists(filename.replace('.bz2', '')):
-            return
+    def _frame_url(self, obj, band):
+        return f"{ self.frames_url }/{ obj['rerun'] }/{ obj['run'] }/{ obj['camcol'] }/frame-{ band }-{ str(obj['run']).zfill(6) }-{ obj['camcol'] }-{ str(obj['field']).zfill(4) }.fits.bz2"
 
-        r = requests.get(url)
-        if r.status_code == 200:
-            with open(filename, 'wb') as fout:
-                fout.write(r.content)
+    def _frame_key(self, obj):
+        # frames are shared by all the objects in the same field
+        return (obj['rerun'], obj['run'], obj['camcol'], obj['field'])
+
+    def _frame_name(self, obj, band):
+        return f"{ obj['rerun'] }/{ obj['run'] }/{ obj['camcol'] }/frame-{ band }-{ str(obj['run']).zfill(6) }-{ obj['camcol'] }-{ str(obj['field']).zfill(4) }.fits.bz2"
+
+    def _frame_cache(self):
+        return get_asset_cache(self.frames_dir, max_bytes=self.frames_max_bytes)
+
+    def _get_frame(self, obj, band):
+        # compressed frame contents, from the frames cache or downloaded and cached
+        cache, name = self._frame_cache(), self._frame_name(obj, band)
+
+        filename = cache.get(name)
+        if filename is not None:
+            try:
+                with open(filename, 'rb') as fin:
+                    return fin.read()
+            except FileNotFoundError:
+                pass
+
+        url = self._frame_url(obj, band)
+        r = httpclient.get(url)
+        if r.status_code != 200:
+            logger.warn(f'Frame request failed { r.status_code } { url }')
+            return None
+        cache.write(name, r.content)
+
+        return r.content
+
+    def _get_frames(self, obj):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+            return list(executor.map(lambda b: self._get_frame(obj, b), BANDS))
+
+    def _frame_cutouts(self, content, coords, size=61):
+        # decompress the frame once and cut the windows around each pair of coordinates in memory
+        cutouts = []
+
+        with fits.open(io.BytesIO(bz2.decompress(content))) as hdul:
+            data, wcs = hdul[0].data, WCS(hdul[0].header)
+            for ra, dec in coords:
+                try:
+                    cutouts.append(np.array(Cutout2D(data, SkyCoord(ra, dec, unit='deg'), size, wcs=wcs).data))
+                except Exception as e:
+                    logger.warn(f'Err cutout { ra } { dec }: { e }')
+                    cutouts.append(None)
+
+        return cutouts
 
-    def save_fits(self, obj, filename=None, base_dir='./'):
-        """ Retrieve and save FITS data file for a given SDSS object.
+    def _save_cutouts(self, obj, arr, filename):
+        if not all(a is not None and a.shape == (61, 61) for a in arr):
+            logger.warn(f"Err shape { obj['objid'] }")
+            return None
+
+        data = np.stack(arr, axis=-1)
+        buf = io.BytesIO()
+        np.save(buf, data)
+        atomic_write(filename, buf.getvalue())
+
+        return data
+
+    def save_fits(self, obj, filename=None, frames=None):
+        """ Retrieve and save FITS data file for a given SDSS object, the frames are kept in the
+            frames cache to be reused by other objects in the same field.
 
             Args:
                 obj: SDSS object
                 filename (str): optional filename
+                frames ([bytes]): optional compressed frames contents for the `u, g, r, i, z` bands, if already retrieved
             Returns:
                 a numpy array
         """
@@ -394,59 +679,66 @@ class Helper:
             with open(filename, 'rb') as fin:
                 return np.load(fin)
 
-        # download frames files
-        urls_files = self._frames_urls_filenames(obj, base_dir=base_dir)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            for u, f in urls_files:
-                executor.submit(self._save_frame, u, f)
-
-        # unzip files
-        for _, f in urls_files:
-            if os.path.exists(f):
-                subprocess.run(['bunzip2', f])  # FIXME make more portable
-
-        # build fits data
-        _exists = []
-        for u, f in urls_files:
-            _exists.append(os.path.exists(f.replace('.bz2', '')))
-
-        result = None
-        if all(_exists):
-            arr = []
-            for _, f in urls_files:
-                tmp = tempfile.NamedTemporaryFile()
-
-                x = FITSImageCutter()
-                x.prepare(f.replace('.bz2', ''))
-                x.fits_cut(obj['ra'], obj['dec'], tmp.name, xs=0.4, ys=0.4)
-
-                hdul = fits.open(tmp.name)
-                data = hdul[0].data
-                if data.shape == (61, 61):
-                    arr.append(data)
-                else:
-                    logger.warn(f"Err shape { obj['objid'] } - { f.replace('.bz2', '') }")
+        if frames is None:
+            frames = self._get_frames(obj)
+        if not all(f is not None for f in frames):
+            logger.warn(f"Frames not available { obj['objid'] }")
+            return None
+
+        try:
+            arr = [self._frame_cutouts(f, [(obj['ra'], obj['dec'])])[0] for f in frames]
+        except Exception as e:
+            logger.warn(f"Err frames { obj['objid'] }: { e }")
+            return None
+
+        return self._save_cutouts(obj, arr, filename)
 
-                tmp.close()
+    def save_fits_many(self, objs, filenames=None, workers=4):
+        """ Retrieve and save FITS data files for a list of SDSS objects, grouped by field so that
+            each frame is retrieved and decompressed once for all the objects in the field.
 
-            if len(arr) == 5:
-                with open(filename, 'wb') as fout:
-                    data = np.stack(arr, axis=-1)
-                    np.save(fout, data)
-                    result = data
+            Args:
+                objs (list): list of SDSS objects
+                filenames ([str]): optional list of filenames, in the same order as `objs`
+                workers (int): number of fields processed in parallel, defaults to `4`
+            Returns:
+                a list of numpy arrays in the same order as `objs`, `None` for objects without data
+        """
+        if filenames is None:
+            filenames = [self._fits_filename(obj['objid']) for obj in objs]
+
+        results = [None] * len(objs)
+        groups = {}
+        for i, (obj, filename) in enumerate(zip(objs, filenames)):
+            if os.path.exists(filename):
+                with open(filename, 'rb') as fin:
+                    results[i] = np.load(fin)
             else:
-                logger.warn(f"Err shape { obj['objid'] }")
+                groups.setdefault(self._frame_key(obj), []).append(i)
+
+        def _field(idx):
+            frames = self._get_frames(objs[idx[0]])
+            if not all(f is not None for f in frames):
+                logger.warn(f'Frames not available { self._frame_key(objs[idx[0]]) }')
+                return
 
-        # delete fits files
-        for _, f in urls_files:
-            f = f.replace('.bz2', '')
-            if os.path.exists(f):
-                os.remove(f)
+            coords = [(objs[i]['ra'], objs[i]['dec']) for i in idx]
+            try:
+                cutouts = [self._frame_cutouts(f, coords) for f in frames]
+            except Exception as e:
+                logger.warn(f'Err frames { self._frame_key(objs[idx[0]]) }: { e }')
+                return
 
-        return result
+            for j, i in enumerate(idx):
+                results[i] = self._save_cutouts(objs[i], [c[j] for c in cutouts], filenames[i])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_field, groups.values()))
+
+        return results
 
     def _spectra_url(self, obj):
-        return f"https://dr16.sdss.org/optical/spectrum/view/data/format=csv/spec=lite?plateid={ obj['plate'] }&mjd={ obj['mjd'] }&fiberid={ obj['fiberid'] }"
+        return f"{ self.spectra_url }?plateid={ obj['plate'] }&mjd={ obj['mjd'] }&fiberid={ obj['fiberid'] }"
 
     def save_spectra(self, obj, filename=None):
         """ Retrieve and save spectra data file for a given SDSS object.
@@ -464,12 +756,10 @@ class Helper:
             return filename
 
         url = self._spectra_url(obj)
-        r = requests.get(url)
+        r = httpclient.get(url)
 
         if r.status_code == 200:
-            with open(filename, 'wb') as fout:
-                fout.write(r.content)
-                return filename
+            return atomic_write(filename, r.content)
 
         return None
 
@@ -503,8 +793,7 @@ class Helper:
 
         if len(dfs) > 0:
             final = concat(dfs)
-            final.to_csv(filename, index=False)
-            return filename
+            return atomic_write(filename, final.to_csv(index=False).encode('utf-8'))
 
         return None
 
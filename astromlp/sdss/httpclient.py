@@ -0,0 +1,177 @@
+
+import logging, threading, time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# responses retried with backoff, by the synchronous and asynchronous clients
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+class _RateLimiter:
+    # spaces requests evenly, at most `rate` requests per second
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # reserve the next slot, and return the delay until it starts
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+
+        return start - now
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+class HTTPClient:
+    """ A HTTP client for remote data, sharing a pool of keep-alive connections, with timeouts,
+        retries with backoff, a limit of concurrent requests per host and optional per host
+        rate limits.
+
+        Attributes:
+            timeout (float): connect and read timeout in seconds, or a tuple of both, defaults to `(10, 120)`
+            retries (int): number of retries for failed requests, defaults to `3`
+            backoff (float): backoff factor between retries in seconds, defaults to `0.5`
+            pool_size (int): number of connections kept alive per host, defaults to `16`
+            max_per_host (int): maximum number of concurrent requests per host, defaults to `8`
+            rate (float): maximum number of requests per second per host, defaults to no limit
+            rates (dict): maximum number of requests per second for specific hosts, overriding `rate`
+    """
+    def __init__(self, timeout=(10, 120), retries=3, backoff=0.5, pool_size=16, max_per_host=8, rate=None, rates=None):
+        """ Constructor method """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.max_per_host = max_per_host
+        self.rate = rate
+        self.rates = rates or {}
+
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUS,
+                      allowed_methods=['GET', 'POST'], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._hosts = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def _host_semaphore(self, url):
+        host = urlparse(url).netloc
+
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.max_per_host)
+
+            return self._hosts[host]
+
+    def _host_limiter(self, url):
+        host = urlparse(url).netloc
+        rate = self.rates.get(host, self.rate)
+        if not rate:
+            return None
+
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = _RateLimiter(rate)
+
+            return self._limiters[host]
+
+    def get(self, url, params=None, timeout=None):
+        """ Perform a GET request.
+
+            Args:
+                url (str): request URL
+                params (dict): query parameters
+                timeout (float): timeout for this request, defaults to the client timeout
+            Returns:
+                a `requests.Response`
+        """
+        limiter = self._host_limiter(url)
+        if limiter is not None:
+            limiter.wait()
+
+        with self._host_semaphore(url):
+            return self.session.get(url, params=params, timeout=timeout or self.timeout)
+
+    def post(self, url, data=None, timeout=None):
+        """ Perform a POST request, only used for read-only queries so failed requests are retried.
+
+            Args:
+                url (str): request URL
+                data (dict): form data
+                timeout (float): timeout for this request, defaults to the client timeout
+            Returns:
+                a `requests.Response`
+        """
+        limiter = self._host_limiter(url)
+        if limiter is not None:
+            limiter.wait()
+
+        with self._host_semaphore(url):
+            return self.session.post(url, data=data, timeout=timeout or self.timeout)
+
+_client, _client_lock = None, threading.Lock()
+
+def get_client():
+    """ Return the HTTP client shared by the process, created on first use.
+
+        Returns:
+            a `HTTPClient`
+    """
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = HTTPClient()
+
+    return _client
+
+def configure(**kwargs):
+    """ Replace the HTTP client shared by the process with a new client, configured with the
+        given arguments (see `HTTPClient`).
+
+        Returns:
+            a `HTTPClient`
+    """
+    global _client
+
+    with _client_lock:
+        _client = HTTPClient(**kwargs)
+
+    return _client
+
+def get(url, params=None, timeout=None):
+    """ Perform a GET request using the HTTP client shared by the process.
+
+        Args:
+            url (str): request URL
+            params (dict): query parameters
+            timeout (float): timeout for this request, defaults to the client timeout
+        Returns:
+            a `requests.Response`
+    """
+    return get_client().get(url, params=params, timeout=timeout)
+
+def post(url, data=None, timeout=None):
+    """ Perform a POST request using the HTTP client shared by the process.
+
+        Args:
+            url (str): request URL
+            data (dict): form data
+            timeout (float): timeout for this request, defaults to the client timeout
+        Returns:
+            a `requests.Response`
+    """
+    return get_client().post(url, data=data, timeout=timeout)
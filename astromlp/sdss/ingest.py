@@ -0,0 +1,305 @@
+
+import os, logging, sqlite3, time, argparse
+import concurrent.futures
+from contextlib import closing
+from pandas import read_csv
+
+from .helper import Helper
+from .cache import MetadataCache
+from .manifest import MODALITIES
+from . import httpclient
+from .pool import process_pool, init_worker, worker_state
+
+logger = logging.getLogger(__name__)
+
+class Journal:
+    """ A persistent journal of the ingestion state of each SDSS object and modality, stored in
+        a SQLite database, so that an interrupted ingestion can be resumed.
+
+        Attributes:
+            filename (str): location of the database file
+    """
+    def __init__(self, filename):
+        """ Constructor method """
+        self.filename = filename
+
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+
+        with closing(self._connect()) as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS state (objid INTEGER, modality TEXT, status TEXT, attempts INTEGER, error TEXT, updated REAL, PRIMARY KEY (objid, modality))')
+
+    def _connect(self):
+        db = sqlite3.connect(self.filename, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+
+        return db
+
+    def pending(self, objids, modality, max_attempts=3):
+        """ Select the objects still to be ingested for a modality.
+
+            Args:
+                objids ([int]): list of SDSS object identifiers
+                modality (str): modality (eg. `img`, `fits`)
+                max_attempts (int): number of attempts before giving up on an object, defaults to `3`
+            Returns:
+                a list of SDSS object identifiers, in the same order as `objids`
+        """
+        with closing(self._connect()) as db:
+            sql = 'SELECT objid FROM state WHERE modality = ? AND (status = ? OR attempts >= ?)'
+            finished = set(x for x, in db.execute(sql, (modality, 'done', max_attempts)))
+
+        return [x for x in objids if int(x) not in finished]
+
+    def update(self, results):
+        """ Record the outcome of a list of ingestion attempts.
+
+            Args:
+                results (list): list of `(objid, modality, status, error)` tuples
+        """
+        now = time.time()
+        rows = [(int(objid), m, status, error, now) for objid, m, status, error in results]
+
+        with closing(self._connect()) as db, db:
+            db.executemany('INSERT INTO state (objid, modality, status, attempts, error, updated) VALUES (?, ?, ?, 1, ?, ?) '
+                           'ON CONFLICT (objid, modality) DO UPDATE SET status = excluded.status, attempts = attempts + 1, '
+                           'error = excluded.error, updated = excluded.updated', rows)
+
+    def summary(self):
+        """ Number of objects per modality and status.
+
+            Returns:
+                a dictionary of dictionaries with the counts per status, by modality
+        """
+        result = {}
+        with closing(self._connect()) as db:
+            for m, status, count in db.execute('SELECT modality, status, COUNT(*) FROM state GROUP BY modality, status'):
+                result.setdefault(m, {})[status] = count
+
+        return result
+
+def _filename(helper, modality, objid):
+    if modality == 'img':
+        return helper._img_filename(objid)
+    if modality == 'fits':
+        return helper._fits_filename(objid)
+    if modality == 'spectra':
+        return helper._spectra_filename(objid)
+    if modality == 'ssel':
+        return helper._ssel_filename(objid)
+
+def _outcome(helper, modality, objid, error=None):
+    filename = _filename(helper, modality, objid)
+    if error is None and os.path.exists(filename):
+        return (objid, modality, 'done', None, os.path.getsize(filename))
+
+    return (objid, modality, 'failed', error or 'not available', 0)
+
+def ingest_objs(helper, items, threads=8):
+    """ Retrieve and save the data files for a list of SDSS objects, using a pool of threads.
+
+        Args:
+            helper (Helper): helper for the `sdss-ds` dataset
+            items (list): list of `(obj, modalities)` tuples
+            threads (int): number of threads, defaults to `8`
+        Returns:
+            a list of `(objid, modality, status, error, bytes)` tuples
+    """
+    def _save(modality, obj, save):
+        try:
+            save(obj)
+            return _outcome(helper, modality, obj['objid'])
+        except Exception as e:
+            return _outcome(helper, modality, obj['objid'], error=f'{ type(e).__name__ }: { e }')
+
+    def _objs(modality):
+        return [obj for obj, modalities in items if modality in modalities]
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        # images and spectra are downloaded per object, the selected bands need the spectra
+        futures = [executor.submit(_save, 'img', obj, helper.save_img) for obj in _objs('img')]
+        futures += [executor.submit(_save, 'spectra', obj, helper.save_spectra) for obj in _objs('spectra')]
+        results += [f.result() for f in futures]
+        results += list(executor.map(lambda obj: _save('ssel', obj, helper.save_ssel), _objs('ssel')))
+
+    # FITS cutouts are grouped by field, so each frame is retrieved once
+    objs = _objs('fits')
+    try:
+        helper.save_fits_many(objs, workers=threads)
+        results += [_outcome(helper, 'fits', obj['objid']) for obj in objs]
+    except Exception as e:
+        results += [_outcome(helper, 'fits', obj['objid'], error=f'{ type(e).__name__ }: { e }') for obj in objs]
+
+    return results
+
+def _init_worker(helper, threads, client):
+    httpclient.configure(**client)
+
+def _worker_chunk(items):
+    # runs in a process pool worker, the helper and settings are sent once per worker
+    state = worker_state()
+
+    return ingest_objs(state['helper'], items, threads=state['threads'])
+
+def _report(results, n_objs, elapsed):
+    report = { 'objects': n_objs, 'elapsed': elapsed, 'bytes': 0, 'modalities': {} }
+
+    for _, m, status, _, nbytes in results:
+        r = report['modalities'].setdefault(m, { 'done': 0, 'failed': 0, 'bytes': 0 })
+        r[status] += 1
+        r['bytes'] += nbytes
+        report['bytes'] += nbytes
+    report['objects_per_second'] = n_objs / elapsed if elapsed > 0 else 0.0
+    report['bytes_per_second'] = report['bytes'] / elapsed if elapsed > 0 else 0.0
+
+    return report
+
+def format_report(report):
+    """ Format a throughput report as text.
+
+        Args:
+            report (dict): throughput report returned by `ingest`
+        Returns:
+            a string
+    """
+    lines = [f"{ report['objects'] } objects in { report['elapsed']:.1f }s, { report['objects_per_second']:.2f } objects/s, "
+             f"{ report['bytes'] / 1024**2:.1f } MB, { report['bytes_per_second'] / 1024**2:.2f } MB/s"]
+    for m, r in report['modalities'].items():
+        lines.append(f"  { m }: { r['done'] } done, { r['failed'] } failed, { r['bytes'] / 1024**2:.1f } MB")
+
+    return '\n'.join(lines)
+
+def read_ids(filename):
+    """ Read a list of SDSS object identifiers from a CSV file with an `objid` column (eg. the
+        `sdss-ds` `data.csv`), or from a text file with one identifier per line.
+
+        Args:
+            filename (str): file location
+        Returns:
+            a list of SDSS object identifiers
+    """
+    if filename.endswith('.csv'):
+        return [int(x) for x in read_csv(filename)['objid']]
+
+    with open(filename, 'r') as fin:
+        return [int(x) for x in fin.read().split() if x]
+
+def ingest(ids, helper=None, x=MODALITIES, journal=None, processes=4, threads=8, chunk_size=64, max_attempts=3, client={}):
+    """ Retrieve and save the data files for a list of SDSS objects into the `sdss-ds` dataset
+        directories, using a pool of processes each running a pool of threads. The state of each
+        object is recorded in a journal, so that running again resumes an interrupted ingestion.
+
+        Args:
+            ids ([int]): list of SDSS object identifiers
+            helper (Helper): helper for the `sdss-ds` dataset
+            x ([str]): list of modalities, defaults to `img`, `fits`, `spectra` and `ssel`
+            journal (Journal): ingestion journal, defaults to `ingest.sqlite` in the dataset directory
+            processes (int): number of processes, defaults to `4`, `0` to run in the current process
+            threads (int): number of threads per process, defaults to `8`
+            chunk_size (int): number of objects per task, defaults to `64`
+            max_attempts (int): number of attempts before giving up on an object, defaults to `3`
+            client (dict): HTTP client arguments (see `HTTPClient`), the rate limits and the maximum number
+                of concurrent requests per host are shared by the processes
+        Returns:
+            a dictionary with the throughput report
+    """
+    start = time.time()
+    helper = helper if helper is not None else Helper()
+    journal = journal if journal is not None else Journal(os.path.join(helper.ds, 'ingest.sqlite'))
+
+    for m in x:
+        os.makedirs(os.path.join(helper.ds, m), exist_ok=True)
+
+    ids = list(dict.fromkeys([int(i) for i in ids]))
+    pending = dict([(m, set(journal.pending(ids, m, max_attempts=max_attempts))) for m in x])
+    ids = [i for i in ids if any(i in pending[m] for m in x)]
+
+    results, items = [], []
+    for objid, obj in zip(ids, helper.get_objs(ids)):
+        modalities = [m for m in x if objid in pending[m]]
+        if obj is None:
+            results += [(objid, m, 'failed', 'object not found', 0) for m in modalities]
+        else:
+            items.append((dict(obj), modalities))
+    journal.update([r[:4] for r in results])
+
+    # objects in the same field are kept together, so frames are shared within a task
+    if 'fits' in x:
+        items.sort(key=lambda item: tuple(str(k) for k in helper._frame_key(item[0])))
+    chunks = [items[i:i+chunk_size] for i in range(0, len(items), chunk_size)]
+
+    # per host limits apply to the whole ingestion, so they are divided by the processes
+    client = dict(client)
+    if processes > 1:
+        client['max_per_host'] = max(1, client.get('max_per_host', httpclient.get_client().max_per_host) // processes)
+        if client.get('rate'):
+            client['rate'] = client['rate'] / processes
+        if client.get('rates'):
+            client['rates'] = dict([(k, v / processes) for k, v in client['rates'].items()])
+
+    def _done(chunk_results, n):
+        results.extend(chunk_results)
+        journal.update([r[:4] for r in chunk_results])
+
+        elapsed = time.time() - start
+        logger.info(f'Ingested { n }/{ len(items) } objects, { n / elapsed:.2f } objects/s')
+
+    n = 0
+    if processes > 0:
+        with process_pool(processes, init=_init_worker, helper=helper, threads=threads, client=client) as executor:
+            futures = dict([(executor.submit(_worker_chunk, c), len(c)) for c in chunks])
+            for f in concurrent.futures.as_completed(futures):
+                n += futures[f]
+                _done(f.result(), n)
+    else:
+        init_worker(init=_init_worker, helper=helper, threads=threads, client=client)
+        for c in chunks:
+            n += len(c)
+            _done(_worker_chunk(c), n)
+
+    return _report(results, len(ids), time.time() - start)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m astromlp.sdss.ingest',
+                                     description='Retrieve and save the data files for a list of SDSS objects into a sdss-ds dataset.')
+    parser.add_argument('ids', help='CSV file with an objid column (eg. data.csv), or text file with one objid per line')
+    parser.add_argument('--ds', default='../sdss-gs', help='location of the sdss-ds dataset')
+    parser.add_argument('--x', nargs='+', default=MODALITIES, choices=MODALITIES, help='modalities to retrieve')
+    parser.add_argument('--journal', help='location of the ingestion journal, defaults to ingest.sqlite in the dataset')
+    parser.add_argument('--processes', type=int, default=4, help='number of processes, 0 to run in the current process')
+    parser.add_argument('--threads', type=int, default=8, help='number of threads per process')
+    parser.add_argument('--chunk-size', type=int, default=64, help='number of objects per task')
+    parser.add_argument('--max-attempts', type=int, default=3, help='number of attempts before giving up on an object')
+    parser.add_argument('--rate', type=float, help='maximum number of requests per second per host')
+    parser.add_argument('--metadata-cache', help='location of the SkyServer metadata cache')
+    parser.add_argument('--frames-dir', help='location of the SDSS frames cache')
+    parser.add_argument('--skyserver-url', help='SkyServer API base URL')
+    parser.add_argument('--frames-url', help='SDSS frames base URL')
+    parser.add_argument('--spectra-url', help='SDSS spectra base URL')
+    parser.add_argument('--manifest', action='store_true', help='rebuild the dataset manifest when finished')
+    args = parser.parse_args(argv)
+
+    # the package configures the root handler on import, in which case basicConfig only
+    # applies when run without it, so the progress level is also set on this logger
+    logging.basicConfig(level=logging.INFO)
+    logger.setLevel(logging.INFO)
+
+    cache = MetadataCache(args.metadata_cache) if args.metadata_cache else None
+    helper = Helper(args.ds, cache=cache, frames_dir=args.frames_dir, frames_url=args.frames_url, spectra_url=args.spectra_url)
+    if args.skyserver_url:
+        helper.ss.base_url = args.skyserver_url
+    journal = Journal(args.journal or os.path.join(args.ds, 'ingest.sqlite'))
+
+    client = { 'rate': args.rate } if args.rate else {}
+    httpclient.configure(**client)
+
+    report = ingest(read_ids(args.ids), helper=helper, x=args.x, journal=journal, processes=args.processes, threads=args.threads,
+                    chunk_size=args.chunk_size, max_attempts=args.max_attempts, client=client)
+    print(format_report(report))
+
+    if args.manifest:
+        helper.build_manifest()
+
+if __name__ == '__main__':
+    main()
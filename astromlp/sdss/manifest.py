@@ -0,0 +1,186 @@
+
+import os, logging
+import numpy as np
+from pandas import read_csv, DataFrame, Index
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+MODALITIES = ['img', 'fits', 'spectra', 'ssel']
+
+def valid_img(filename):
+    """ Check if a RGB image file is available.
+
+        Args:
+            filename (str): RGB image filename
+        Returns:
+            `True` if the file is valid
+    """
+    return os.path.exists(filename) and os.path.getsize(filename) > 0
+
+def valid_fits(filename):
+    """ Check if a FITS data file is available and has the expected shape.
+
+        Args:
+            filename (str): FITS data filename
+        Returns:
+            `True` if the file is valid
+    """
+    if os.path.exists(filename):
+        try:
+            return np.load(filename, mmap_mode='r').shape == (61, 61, 5)
+        except ValueError:
+            pass
+
+    return False
+
+def valid_spectra(filename):
+    """ Check if a spectra data file is available and has the expected shape.
+
+        Args:
+            filename (str): spectra data filename
+        Returns:
+            `True` if the file is valid
+    """
+    if os.path.exists(filename):
+        _df = read_csv(filename)
+        if len(_df)>0 and 'Wavelength' in _df.columns and 'BestFit' in _df.columns:
+            _x = _df[(_df['Wavelength']>=4000) & (_df['Wavelength']<=9000.0)]['BestFit'].to_numpy()
+            if len(_x) == 3522:
+                return True
+
+    return False
+
+def valid_ssel(filename):
+    """ Check if a spectra selected bands data file is available and has the expected shape.
+
+        Args:
+            filename (str): spectra selected bands data filename
+        Returns:
+            `True` if the file is valid
+    """
+    if os.path.exists(filename):
+        _df = read_csv(filename)
+        if 'BestFit' in _df.columns and _df['BestFit'].to_numpy().shape == (1423,):
+            return True
+
+    return False
+
+_VALID = { 'img': valid_img, 'fits': valid_fits, 'spectra': valid_spectra, 'ssel': valid_ssel }
+
+def _validate(task):
+    modality, filename = task
+
+    # a corrupt file is not valid, and must not abort the whole build
+    try:
+        return _VALID[modality](filename)
+    except Exception as e:
+        logger.warn(f'Invalid { modality } file { filename }: { e }')
+        return False
+
+def _stat(filename):
+    try:
+        st = os.stat(filename)
+        return st.st_mtime_ns, st.st_size
+    except FileNotFoundError:
+        return -1, -1
+
+def _stats(filenames):
+    stats = np.array([_stat(f) for f in filenames], dtype=np.int64).reshape(-1, 2)
+
+    return stats[:, 0], stats[:, 1]
+
+def _unchanged(previous, m, pos, mtimes, sizes):
+    # files with the same modification time and size as recorded in a previous manifest
+    same = (pos >= 0) & (np.where(pos >= 0, previous[f'{ m }_mtime'].to_numpy(dtype=np.int64)[pos], -2) == mtimes)
+    if f'{ m }_size' in previous.columns:
+        same &= np.where(pos >= 0, previous[f'{ m }_size'].to_numpy(dtype=np.int64)[pos], -2) == sizes
+
+    return same
+
+def build_manifest(ids, filenames, previous=None, workers=None):
+    """ Build a manifest of the data available for a list of SDSS objects, with one flag
+        per modality. Files are validated in parallel, and given a previous manifest only
+        files that changed since are validated again.
+
+        Args:
+            ids ([int]): list of SDSS object identifiers
+            filenames (dict): list of filenames per modality, in the same order as `ids`
+            previous (DataFrame): previous manifest, optional
+            workers (int): number of processes used to validate files, defaults to the number of CPUs
+        Returns:
+            a `DataFrame` with the `objid`, `has_<modality>`, `<modality>_mtime` and `<modality>_size` columns
+    """
+    manifest = DataFrame({ 'objid': np.asarray(ids, dtype=np.int64) })
+
+    pos = np.full(len(ids), -1)
+    if previous is not None and len(previous) > 0:
+        pos = Index(previous['objid']).get_indexer(manifest['objid'])
+
+    tasks, slots = [], []
+    for m in MODALITIES:
+        mtimes, sizes = _stats(filenames[m])
+        flags = np.zeros(len(ids), dtype=bool)
+        todo = mtimes >= 0
+
+        if previous is not None and f'{ m }_mtime' in previous.columns:
+            same = _unchanged(previous, m, pos, mtimes, sizes)
+            flags[same] = previous[f'has_{ m }'].to_numpy(dtype=bool)[pos[same]]
+            todo &= ~same
+
+        for i in np.flatnonzero(todo):
+            tasks.append((m, filenames[m][i]))
+            slots.append((m, i))
+
+        manifest[f'has_{ m }'] = flags
+        manifest[f'{ m }_mtime'] = mtimes
+        manifest[f'{ m }_size'] = sizes
+
+    if len(tasks) > 0:
+        logger.info(f'Validating { len(tasks) } data files')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for (m, i), ok in zip(slots, executor.map(_validate, tasks, chunksize=256)):
+                manifest.at[i, f'has_{ m }'] = ok
+
+    return manifest
+
+def changed(manifest, modality, ids, filenames):
+    """ Find the files of a modality that changed since a manifest was built, comparing
+        the modification time and size of each file with the ones recorded.
+
+        Args:
+            manifest (DataFrame): the manifest
+            modality (str): the modality (eg. `img`)
+            ids ([int]): list of SDSS object identifiers
+            filenames ([str]): list of filenames, in the same order as `ids`
+        Returns:
+            a boolean numpy array, `True` for files that changed or objects not in the manifest
+    """
+    pos = Index(manifest['objid']).get_indexer(np.asarray(ids, dtype=np.int64))
+    mtimes, sizes = _stats(filenames)
+
+    return ~_unchanged(manifest, modality, pos, mtimes, sizes)
+
+def save_manifest(manifest, filename):
+    """ Save a manifest to a CSV file, replacing any existing file atomically.
+
+        Args:
+            manifest (DataFrame): the manifest
+            filename (str): manifest filename
+    """
+    tmp = f'{ filename }.tmp'
+    manifest.to_csv(tmp, index=False)
+    os.replace(tmp, filename)
+
+def load_manifest(filename):
+    """ Load a manifest from a CSV file.
+
+        Args:
+            filename (str): manifest filename
+        Returns:
+            a `DataFrame`, or `None` if the file is not available
+    """
+    if os.path.exists(filename):
+        return read_csv(filename)
+
+    return None
@@ -0,0 +1,40 @@
+
+import functools
+import concurrent.futures
+
+# state for process pool workers, set once per worker so tasks only send their own arguments
+_state = {}
+
+def init_worker(init=None, **state):
+    """ Set the state of the current process as a pool worker, also used to run the
+        tasks in the current process.
+
+        Args:
+            init (callable): function called with the state once the state is set, optional
+            state: state values (eg. `helper`), available to tasks using `worker_state`
+    """
+    _state.clear()
+    _state.update(state)
+
+    if init is not None:
+        init(**state)
+
+def worker_state():
+    """ Return the state of the current process as a pool worker.
+
+        Returns:
+            the state dictionary
+    """
+    return _state
+
+def process_pool(max_workers, init=None, **state):
+    """ Create a pool of processes, with a state set once per worker (see `init_worker`).
+
+        Args:
+            max_workers (int): number of processes
+            init (callable): function called in each worker with the state, optional, must be picklable
+            state: state values sent once to each worker, must be picklable
+        Returns:
+            a `ProcessPoolExecutor`
+    """
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=functools.partial(init_worker, init, **state))
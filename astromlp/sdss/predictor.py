@@ -1,9 +1,8 @@
 
-import os, random, requests, time, pathlib, base64, tempfile, io, logging, subprocess
+import os, random, requests, time, pathlib, base64, tempfile, io, logging
 import pandas as pd
 import numpy as np
 import tensorflow as tf
-from ImageCutter.ImageCutter import FITSImageCutter
 from astropy.io import fits
 import matplotlib.pyplot as plt
 
@@ -12,23 +11,38 @@ logger = logging.getLogger(__name__)
 from .helper import Helper
 from .skyserver import SkyServer
 from .shared import CLASSES
+from .registry import registry as default_registry, load_model_manifest
+from .cache import get_asset_cache
 
 class Predictor:
     """ A predictor class for predicting data using `astromlp-models <https://github.com/nunorc/astromlp-models>`_.
 
+        Models given by identifier or path are loaded on first use from the model registry,
+        shared by all predictors in the process. Remote data is kept in an asset cache in the `assets`
+        subdirectory of the temporary files directory, bounded by the `ASTROMLP_TMP_MAX_BYTES` environment variable.
+
         Attributes:
             model (str): the astromlp-model identifier (eg, `i2r`, `f2s`)
             model_store (str): location of the model store, defaults to `'./astromlp-models/model_store'`
+            registry (ModelRegistry): model registry, defaults to the registry shared by the process
+            compiled (bool): run inference using a traced `tf.function` instead of `predict`, defaults to `False`
+            jit_compile (bool): compile the traced function using XLA, defaults to `False`
+            assets (AssetCache): cache for remote data, defaults to the cache shared by the process in `tmp_dir/assets`
     """
-    def __init__(self, model, model_store='./astromlp-models/model_store', x=None, y=None, helper=None, tmp_dir='/tmp/mysdss'):
+    def __init__(self, model, model_store='./astromlp-models/model_store', x=None, y=None, helper=None, tmp_dir='/tmp/mysdss', registry=None,
+                 compiled=False, jit_compile=False, assets=None):
         if helper:
             self.helper = helper
         else:
             self.helper = Helper()
 
         self.skyserver = SkyServer()
+        self.registry = registry if registry is not None else default_registry
+        self.compiled = compiled
+        self.jit_compile = jit_compile
+        self._fn = None
 
-        self.model = None
+        self._model, self._model_path, self._spec, self._names = None, None, None, None
         if model:
             if isinstance(model, str):
                 if not os.path.exists(model):
@@ -36,35 +50,122 @@ class Predictor:
                 else:
                     filename = model
                 if os.path.exists(filename):
-                    self.model = tf.keras.models.load_model(filename)
+                    self._model_path = filename
+                    self._spec = load_model_manifest(os.path.dirname(os.path.abspath(filename))).get(os.path.basename(os.path.abspath(filename)))
                 else:
                     logger.warn(f'Model not found { filename }')
             else:
-                self.model = model
+                self._model = model
 
-        if x:
-            self.x = x
-        else:
-            if self.model:
-                self.x = self.model.input_names
-        if y:
-            self.y = y
-        else:
-            if self.model:
-                self.y = self.model.output_names
+        self._x, self._y = x, y
 
         self.tmp_dir = tmp_dir
         pathlib.Path(self.tmp_dir).mkdir(parents=True, exist_ok=True)
+        self.assets = assets if assets is not None else get_asset_cache(os.path.join(self.tmp_dir, 'assets'))
+
+    @property
+    def model(self):
+        model = self.registry.get(self._model_path) if self._model_path is not None else self._model
+
+        # input and output names are kept once the model is loaded, so that they
+        # do not go through the registry again
+        if self._names is None and model is not None:
+            self._names = (list(model.input_names), list(model.output_names))
+
+        return model
+
+    def _io_names(self, key):
+        if self._spec is not None:
+            return list(self._spec[key].keys())
+        if self._names is None:
+            self.model
+
+        if self._names is not None:
+            return self._names[0 if key == 'inputs' else 1]
+
+    @property
+    def x(self):
+        if not self._x:
+            return self._io_names('inputs')
+
+        return self._x
+
+    @property
+    def y(self):
+        if not self._y:
+            return self._io_names('outputs')
+
+        return self._y
+
+    def _build_fn(self, model):
+        # traced function with a fixed input signature, warmed up with dummy inputs so
+        # that the first request does not pay the tracing cost
+        specs = dict([(n, tf.TensorSpec((None,) + tuple(t.shape[1:]), tf.float32)) for n, t in zip(model.input_names, model.inputs)])
+        fn = tf.function(lambda inputs: model(inputs, training=False), input_signature=[specs], jit_compile=self.jit_compile)
+        fn(dict([(n, tf.zeros((1,) + tuple(1 if d is None else d for d in spec.shape[1:]))) for n, spec in specs.items()]))
+
+        return fn
+
+    def _get_fn(self):
+        if self._model_path is not None:
+            return self.registry.extra(self._model_path, ('fn', self.jit_compile), self._build_fn)
+
+        if self._fn is None:
+            self._fn = self._build_fn(self._model)
+
+        return self._fn
+
+    def warmup(self):
+        """ Load the model, and trace and warm up the inference function when compiled. """
+        self.model
+        if self.compiled:
+            self._get_fn()
+
+    def _forward(self, _input, batch_size=None):
+        if not self.compiled:
+            if batch_size is None:
+                return self.model.predict(_input)
+            return self.model.predict(_input, batch_size=batch_size, verbose=0)
+
+        fn = self._get_fn()
+        n = len(next(iter(_input.values())))
+        batch_size = batch_size or n
+        outputs = []
+        for start in range(0, n, batch_size):
+            _output = fn(dict([(x, tf.convert_to_tensor(_input[x][start:start+batch_size], tf.float32)) for x in self.x]))
+            outputs.append(_output if isinstance(_output, (list, tuple)) else [_output])
+        outputs = [np.concatenate([o[i].numpy() for o in outputs]) for i in range(len(outputs[0]))]
+
+        return outputs if len(self.y) > 1 else outputs[0]
+
+    def _tmp_filename(self, objid, suffix):
+        return self.assets.path(f'{ objid }{ suffix }')
+
+    def _tmp_asset(self, objid, suffix, save):
+        # retrieve a file from the asset cache, saving it on a miss
+        name = f'{ objid }{ suffix }'
+
+        filename = self.assets.get(name)
+        if filename is None:
+            filename = save(self.assets.path(name))
+            if filename:
+                self.assets.add(name)
+
+        return filename
 
     def _handle_img(self, obj, extra=True):
         _input, _extra = None, None
 
+        store = self.helper._store('img')
+        if store is not None and obj['objid'] in store and not extra:
+            return self.helper.load_imgs([obj['objid']]), _extra
+
         if self.helper._has_img(obj['objid']):
             filename = self.helper._img_filename(obj['objid'])
         else:
-            filename = os.path.join(self.tmp_dir, str(obj['objid'])+'.jpg')
+            filename = self._tmp_asset(obj['objid'], '.jpg', lambda f: self.helper.save_img(obj, filename=f))
 
-        if self.helper.save_img(obj, filename=filename):
+        if filename:
             _input = np.array([self.helper.load_img(filename)])
 
             if extra:
@@ -76,34 +177,72 @@ class Predictor:
     def _handle_fits(self, obj, extra=True):
         _input, _extra = None, None
 
-        if self.helper._has_fits(obj['objid']):
-            filename = self.helper._fits_filename(obj['objid'])
+        store = self.helper._store('fits')
+        if store is not None and obj['objid'] in store:
+            data = store.row(obj['objid']).astype(np.float32)
         else:
-            filename = os.path.join(self.tmp_dir, f"{ obj['objid'] }.npy")
-
-        data = self.helper.save_fits(obj, filename=filename, base_dir=self.tmp_dir)
+            if self.helper._has_fits(obj['objid']):
+                data = self.helper.save_fits(obj, filename=self.helper._fits_filename(obj['objid']))
+            else:
+                name = f"{ obj['objid'] }.npy"
+                hit = self.assets.get(name)
+                data = self.helper.save_fits(obj, filename=self.assets.path(name))
+                if hit is None and data is not None:
+                    self.assets.add(name)
+        if data is None:
+            return _input, _extra
         _input = np.array([data])
 
         if extra:
             _extra = []
             for i in range(5):
-                _tmp_file = f"{ obj['objid'] }_band_{ i }.jpg"
-                if not os.path.exists(_tmp_file):
-                    plt.imsave(os.path.join(self.tmp_dir, _tmp_file), data[:, :, i])
-                with open(os.path.join(self.tmp_dir, _tmp_file), 'rb') as fin:
-                    _extra.append(base64.b64encode(fin.read()).decode('utf-8'))
+                name = f"{ obj['objid'] }_band_{ i }.jpg"
+                filename = self.assets.get(name)
+                if filename is None:
+                    buf = io.BytesIO()
+                    plt.imsave(buf, data[:, :, i], format='jpg')
+                    content = buf.getvalue()
+                    self.assets.write(name, content)
+                else:
+                    with open(filename, 'rb') as fin:
+                        content = fin.read()
+                _extra.append(base64.b64encode(content).decode('utf-8'))
 
         return _input, _extra
 
+    def _prefetch_fits(self, objs):
+        # cut the FITS data for the objects not available locally grouped by field, so
+        # that each frame is retrieved once
+        store = self.helper._store('fits')
+        objs = [obj for obj in objs if not (store is not None and obj['objid'] in store) and not self.helper._has_fits(obj['objid'])]
+        objs = [obj for obj in objs if self.assets.get(f"{ obj['objid'] }.npy") is None]
+
+        results = self.helper.save_fits_many(objs, filenames=[self._tmp_filename(obj['objid'], '.npy') for obj in objs])
+        for obj, data in zip(objs, results):
+            if data is not None:
+                self.assets.add(f"{ obj['objid'] }.npy")
+
+    def _spectra_file(self, obj):
+        # spectra data file, from the dataset or the asset cache
+        if self.helper._has_spectra(obj['objid']):
+            return self.helper._spectra_filename(obj['objid'])
+
+        return self._tmp_asset(obj['objid'], '_spectra.csv', lambda f: self.helper.save_spectra(obj, filename=f))
+
     def _handle_spectra(self, obj, extra=True):
         _input, _extra = None, None
 
-        if self.helper._has_spectra(obj['objid']):
-            filename = self.helper._spectra_filename(obj['objid'])
-        else:
-            filename = os.path.join(self.tmp_dir, f"{ obj['objid'] }_spectra.csv")
+        store = self.helper._store('spectra')
+        if store is not None and obj['objid'] in store:
+            _input = store.row(obj['objid'])[np.newaxis]
+            if extra:
+                _extra = store.aux('waves').tolist()
+
+            return _input, _extra
 
-        self.helper.save_spectra(obj, filename=filename)
+        filename = self._spectra_file(obj)
+        if filename is None:
+            return _input, _extra
         spectra, waves = self.helper.load_spectra(filename)
         _input = np.array([spectra])
 
@@ -115,13 +254,26 @@ class Predictor:
     def _handle_ssel(self, obj, extra=True):
         _input, _extra = None, None
 
+        store = self.helper._store('ssel')
+        if store is not None and obj['objid'] in store:
+            _input = store.row(obj['objid'])[np.newaxis]
+            if extra:
+                _extra = store.aux('waves').tolist()
+
+            return _input, _extra
+
+        def _save(f):
+            spectra_filename = self._spectra_file(obj)
+            if spectra_filename is None:
+                return None
+            return self.helper.save_ssel(obj, filename=f, spectra_filename=spectra_filename)
+
         if self.helper._has_ssel(obj['objid']):
             filename = self.helper._ssel_filename(obj['objid'])
         else:
-            filename = os.path.join(self.tmp_dir, f"{ obj['objid'] }_ssel.csv")
- 
-        spectra_filename = os.path.join(self.tmp_dir, f"{ obj['objid'] }_spectra.csv")
-        self.helper.save_ssel(obj, filename=filename, spectra_filename=spectra_filename)
+            filename = self._tmp_asset(obj['objid'], '_ssel.csv', _save)
+        if filename is None:
+            return _input, _extra
         ssel, waves = self.helper.load_ssel(filename)
         _input = np.array([ssel])
 
@@ -130,40 +282,36 @@ class Predictor:
 
         return _input, _extra
 
-    def predict(self, objid, extra=True, return_input=True):
-        """ Perform a prediction on a model for a SDSS object identifier.
-
-            Args:
-                objid (id): SDSS object identifier
-            Returns:
-                an object where the key `output` contains the resulting prediction
-
-        """
-        need_wise = 'wise' in self.x
-        obj = self.helper.get_obj(objid, wise=need_wise)
-        if obj is None:
-            return None
-
-        _input, _extra, _result = {}, {}, { 'obj': obj }
-        if 'img' in self.x:
-            _input['img'], _extra['img'] = self._handle_img(obj, extra=extra)
-
-        if 'fits' in self.x:
-            _input['fits'], _extra['fits'] = self._handle_fits(obj, extra=extra)
-
-        if 'spectra' in self.x:
-            _input['spectra'], _extra['spectra'] = self._handle_spectra(obj, extra=extra)
-
-        if 'ssel' in self.x:
-            _input['ssel'], _extra['ssel'] = self._handle_ssel(obj, extra=extra)
-
-        if 'bands' in self.x:
-            _input['bands'] = np.array([[obj['modelMag_u'], obj['modelMag_g'], obj['modelMag_r'], obj['modelMag_i'], obj['modelMag_z']]])
+    def _input(self, obj, x, extra=True):
+        # build model input and extra data for a single object and input variable
+        if x == 'img':
+            return self._handle_img(obj, extra=extra)
+        if x == 'fits':
+            return self._handle_fits(obj, extra=extra)
+        if x == 'spectra':
+            return self._handle_spectra(obj, extra=extra)
+        if x == 'ssel':
+            return self._handle_ssel(obj, extra=extra)
+        if x == 'bands':
+            return np.array([[obj['modelMag_u'], obj['modelMag_g'], obj['modelMag_r'], obj['modelMag_i'], obj['modelMag_z']]]), None
+        if x == 'wise':
+            return np.array([[obj['w1mag'], obj['w2mag'], obj['w3mag'], obj['w4mag']]]), None
+
+        return None, None
+
+    def _inputs(self, obj, extra=True):
+        # build model input and extra data for a single object
+        _input, _extra = {}, {}
+        for x in self.x:
+            _input[x], _e = self._input(obj, x, extra=extra)
+            if x in ['img', 'fits', 'spectra', 'ssel']:
+                _extra[x] = _e
 
-        if 'wise' in self.x:
-            _input['wise'] = np.array([[obj['w1mag'], obj['w2mag'], obj['w3mag'], obj['w4mag']]])
+        return _input, _extra
 
-        _output = self.model.predict(_input)
+    def _result(self, obj, _input, _output, _extra, extra=True, return_input=True):
+        # build the result for a single object given the model output for a batch of one
+        _result = { 'obj': obj }
 
         _result['_classes'] = {}
         for i in self.y:
@@ -192,4 +340,102 @@ class Predictor:
 
         return _result
 
+    def predict(self, objid, extra=True, return_input=True, obj=None):
+        """ Perform a prediction on a model for a SDSS object identifier.
+
+            Args:
+                objid (id): SDSS object identifier
+                obj: SDSS object, optional if already retrieved
+            Returns:
+                an object where the key `output` contains the resulting prediction
+
+        """
+        if obj is None:
+            need_wise = 'wise' in self.x
+            obj = self.helper.get_obj(objid, wise=need_wise)
+        if obj is None:
+            return None
+
+        _input, _extra = self._inputs(obj, extra=extra)
+        _output = self._forward(_input)
+
+        return self._result(obj, _input, _output, _extra, extra=extra, return_input=return_input)
+
+    def predict_input(self, obj, _input, return_input=False):
+        """ Perform a prediction on a model for a SDSS object given inputs already prepared,
+            eg. shared by several predictors.
+
+            Args:
+                obj: SDSS object
+                _input (dict): model inputs per variable, batches of one object
+                return_input (bool): include the model input in the result, defaults to `False`
+            Returns:
+                an object where the key `output` contains the resulting prediction
+        """
+        _input = dict([(x, _input[x]) for x in self.x])
+        _output = self._forward(_input)
+
+        return self._result(obj, _input, _output, {}, extra=False, return_input=return_input)
+
+    def predict_arrays(self, _input, batch_size=256):
+        """ Run the model on a batch of inputs already prepared.
+
+            Args:
+                _input (dict): model inputs per variable, batches of objects
+                batch_size (int): number of objects per forward pass, defaults to `256`
+            Returns:
+                a dictionary with a numpy array per output variable
+        """
+        _input = dict([(x, _input[x]) for x in self.x])
+        _output = self._forward(_input, batch_size=batch_size)
+        if len(self.y) == 1:
+            _output = [_output]
+
+        return dict(zip(self.y, _output))
+
+    def predict_batch(self, objids, extra=True, return_input=True, batch_size=256):
+        """ Perform predictions on a model for a list of SDSS object identifiers, running
+            one forward pass per chunk of objects.
+
+            Args:
+                objids ([int]): list of SDSS object identifiers
+                extra (bool): include extra data in the results, defaults to `True`
+                return_input (bool): include the model input in the results, defaults to `True`
+                batch_size (int): number of objects per forward pass, defaults to `256`
+            Returns:
+                a list of results in the same format as `predict`, in the same order as `objids`,
+                `None` for objects not found or without input data
+        """
+        need_wise = 'wise' in self.x
+        objs = self.helper.get_objs(objids, wise=need_wise)
+
+        _results = [None] * len(objs)
+        _valid = [i for i, obj in enumerate(objs) if obj is not None]
+
+        for start in range(0, len(_valid), batch_size):
+            if 'fits' in self.x:
+                self._prefetch_fits([objs[i] for i in _valid[start:start+batch_size]])
+
+            idx, inputs, extras = [], [], []
+            for i in _valid[start:start+batch_size]:
+                _input, _extra = self._inputs(objs[i], extra=extra)
+                if any(v is None for v in _input.values()):
+                    logger.warn(f"Input data not available { objs[i]['objid'] }")
+                    continue
+                idx.append(i)
+                inputs.append(_input)
+                extras.append(_extra)
+            if len(idx) == 0:
+                continue
+
+            _input = dict([(k, np.concatenate([x[k] for x in inputs])) for k in inputs[0].keys()])
+            _output = self._forward(_input, batch_size=len(idx))
+
+            for j, i in enumerate(idx):
+                if len(self.y) > 1:
+                    _output_j = [x[j:j+1] for x in _output]
+                else:
+                    _output_j = _output[j:j+1]
+                _results[i] = self._result(objs[i], inputs[j], _output_j, extras[j], extra=extra, return_input=return_input)
 
+        return _results
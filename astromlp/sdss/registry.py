@@ -0,0 +1,276 @@
+
+import os, logging, threading, json, time
+import concurrent.futures
+from collections import OrderedDict, Counter
+import numpy as np
+import tensorflow as tf
+
+logger = logging.getLogger(__name__)
+
+def _model_bytes(model):
+    return sum(int(np.prod(w.shape)) * w.dtype.size for w in model.weights)
+
+def _saved_bytes(path):
+    # size of the saved weights, an estimate of the memory used by a model before loading it
+    d = os.path.join(path, 'variables')
+    if not os.path.isdir(d):
+        return 0
+
+    return sum(os.path.getsize(os.path.join(d, x)) for x in os.listdir(d))
+
+class ModelRegistry:
+    """ A registry of the models loaded in the process, keyed by model path, so that predictors
+        and pipelines using the same model share a single instance. Models are loaded on first
+        use, and the least recently used models are evicted when the memory budget is exceeded.
+
+        Attributes:
+            max_bytes (int): memory budget for the models weights in bytes, defaults to no limit
+    """
+    def __init__(self, max_bytes=None):
+        """ Constructor method """
+        self.max_bytes = max_bytes
+
+        self._models = OrderedDict()
+        self._extras = {}
+        self._pinned = Counter()
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self._models
+
+    def __len__(self):
+        return len(self._models)
+
+    @property
+    def nbytes(self):
+        """ Memory used by the weights of the models currently loaded, in bytes. """
+        return sum(size for _, size in self._models.values())
+
+    def get(self, path):
+        """ Return the model for a given path, loading it if necessary.
+
+            Args:
+                path (str): location of the model
+            Returns:
+                a Keras model
+        """
+        path = os.path.abspath(path)
+
+        with self._lock:
+            if path in self._models:
+                self._models.move_to_end(path)
+                return self._models[path][0]
+            lock = self._loading.setdefault(path, threading.Lock())
+
+        # load each model only once, even if requested by several threads
+        with lock:
+            with self._lock:
+                if path in self._models:
+                    self._models.move_to_end(path)
+                    return self._models[path][0]
+
+            model = tf.keras.models.load_model(path)
+            logger.info(f'Model loaded { path }')
+            _record_model(path, model)
+
+            with self._lock:
+                self._models[path] = (model, _model_bytes(model))
+                self._evict()
+
+        return model
+
+    def extra(self, path, key, build):
+        """ Return an object derived from a model (eg. a compiled function), built once per
+            model and evicted together with the model.
+
+            Args:
+                path (str): location of the model
+                key: identifier of the derived object
+                build (callable): function building the object given the model
+            Returns:
+                the derived object
+        """
+        model = self.get(path)
+        path = os.path.abspath(path)
+
+        with self._lock:
+            if key in self._extras.get(path, {}):
+                return self._extras[path][key]
+
+        value = build(model)
+        with self._lock:
+            if path in self._models:
+                value = self._extras.setdefault(path, {}).setdefault(key, value)
+
+        return value
+
+    def pin(self, path):
+        """ Return the model for a given path, loading it if necessary, and keep it loaded until
+            unpinned. Pinned models count against the memory budget but are never evicted.
+
+            Args:
+                path (str): location of the model
+            Returns:
+                a Keras model
+        """
+        with self._lock:
+            self._pinned[os.path.abspath(path)] += 1
+
+        return self.get(path)
+
+    def unpin(self, path):
+        """ Release a model pinned using `pin`, so that it can be evicted again.
+
+            Args:
+                path (str): location of the model
+        """
+        path = os.path.abspath(path)
+
+        with self._lock:
+            self._pinned[path] -= 1
+            if self._pinned[path] <= 0:
+                del self._pinned[path]
+            self._evict()
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+
+        # the most recently used model is kept, as it was just requested
+        candidates = [x for x in list(self._models.keys())[:-1] if x not in self._pinned]
+        while len(candidates) > 0 and self.nbytes > self.max_bytes:
+            path = candidates.pop(0)
+            del self._models[path]
+            self._extras.pop(path, None)
+            logger.info(f'Model evicted { path }')
+
+    def preload(self, paths, max_workers=8):
+        """ Load a list of models in parallel, within the memory budget. Models are taken in
+            order, and those that would exceed the budget, estimated from the size of the saved
+            weights, are skipped and loaded on first use instead.
+
+            Args:
+                paths ([str]): list of models locations
+                max_workers (int): number of models loaded in parallel, defaults to `8`
+            Returns:
+                a dictionary with the loading time in seconds per model path, for the models loaded
+        """
+        def _load(path):
+            start = time.time()
+            self.get(path)
+
+            return time.time() - start
+
+        paths, skipped = list(dict.fromkeys(paths)), []
+        if self.max_bytes is not None:
+            _paths, total = [], self.nbytes
+            for path in paths:
+                if path not in self:
+                    size = _saved_bytes(path)
+                    if total + size > self.max_bytes:
+                        skipped.append(path)
+                        continue
+                    total += size
+                _paths.append(path)
+            paths = _paths
+
+        if len(skipped) > 0:
+            logger.warn(f'Models not preloaded, exceeding the memory budget: { ", ".join(skipped) }')
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(paths, executor.map(_load, paths)))
+
+    def clear(self):
+        """ Remove all the models from the registry. """
+        with self._lock:
+            self._models.clear()
+            self._extras.clear()
+
+MANIFEST = 'manifest.json'
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def _specs(tensors, names):
+    return dict([(n, list(t.shape)[1:]) for n, t in zip(names, tensors)])
+
+def _manifest_entry(model):
+    return { 'inputs': _specs(model.inputs, model.input_names), 'outputs': _specs(model.outputs, model.output_names) }
+
+def _save_model_manifest(model_store, manifest):
+    filename = os.path.join(model_store, MANIFEST)
+    with open(f'{ filename }.tmp', 'w') as fout:
+        json.dump(manifest, fout, indent=2)
+    os.replace(f'{ filename }.tmp', filename)
+
+def _record_model(path, model):
+    # add a model loaded from a store to the store manifest when missing, so that the
+    # manifest is created as models are used if it was not built beforehand
+    model_store, name = os.path.split(path)
+    with _manifests_lock:
+        manifest = load_model_manifest(model_store)
+        if name in manifest:
+            return
+
+        manifest[name] = _manifest_entry(model)
+        try:
+            _save_model_manifest(model_store, manifest)
+        except OSError as e:
+            logger.warn(f'Unable to save model manifest in { model_store }: { e }')
+
+def build_model_manifest(model_store, names=None):
+    """ Build the manifest of a model store, recording the inputs and outputs names and shapes
+        of each model, so that pipelines can be planned without loading the models. The manifest
+        is also updated as models are loaded by the registry.
+
+        Args:
+            model_store (str): location of the model store
+            names ([str]): list of models identifiers, defaults to all models in the store
+        Returns:
+            the manifest dictionary
+    """
+    if names is None:
+        names = sorted([x for x in os.listdir(model_store) if os.path.isdir(os.path.join(model_store, x))])
+
+    entries = dict([(name, _manifest_entry(tf.keras.models.load_model(os.path.join(model_store, name)))) for name in names])
+    with _manifests_lock:
+        manifest = load_model_manifest(model_store)
+        manifest.update(entries)
+        _save_model_manifest(model_store, manifest)
+
+    return manifest
+
+def load_model_manifest(model_store):
+    """ Load the manifest of a model store.
+
+        Args:
+            model_store (str): location of the model store
+        Returns:
+            the manifest dictionary, empty if the manifest is not available
+    """
+    model_store = os.path.abspath(model_store)
+
+    if model_store not in _manifests:
+        _manifests[model_store] = {}
+        filename = os.path.join(model_store, MANIFEST)
+        if os.path.exists(filename):
+            with open(filename, 'r') as fin:
+                _manifests[model_store] = json.load(fin)
+
+    return _manifests[model_store]
+
+# registry shared by all predictors in the process, the memory budget can be set
+# using the ASTROMLP_MODELS_MAX_BYTES environment variable
+registry = ModelRegistry(max_bytes=int(os.environ['ASTROMLP_MODELS_MAX_BYTES']) if 'ASTROMLP_MODELS_MAX_BYTES' in os.environ else None)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the manifest of a model store.')
+    parser.add_argument('model_store', nargs='?', default='./astromlp-models/model_store', help='location of the model store')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    manifest = build_model_manifest(args.model_store)
+    logger.info(f'Manifest built for { len(manifest) } models in { args.model_store }')
@@ -7,3 +7,18 @@ CLASSES = {
 }
 
 SM_FACTOR = 1e9
+
+BANDS = ['u', 'g', 'r', 'i', 'z']
+
+SHAPES = {
+	'img': (150, 150, 3),
+	'fits': (61, 61, 5),
+	'spectra': (3522,),
+	'ssel': (1423,),
+	'bands': (5,),
+	'wise': (4,),
+	'redshift': (),
+	'smass': (),
+	'subclass': (len(CLASSES['subclass']),),
+	'gz2c': (len(CLASSES['gz2c']),)
+}
@@ -1,5 +1,8 @@
 
-import os, requests, logging
+import os, logging
+
+from . import httpclient
+from .cache import atomic_write
 
 logger = logging.getLogger(__name__)
 
@@ -7,10 +10,12 @@ class SkyServer:
     """ Helper class to perform operations using the `SkyServer Web Service <http://skyserver.sdss.org>`_.
 
         Attributes:
-            base_url (str): SkyServer API base URL
+            base_url (str): SkyServer API base URL, defaults to the `ASTROMLP_SKYSERVER_URL` environment variable, or DR16
+            cache (MetadataCache): persistent cache for objects metadata, optional
     """
-    def __init__(self, base_url='http://skyserver.sdss.org/dr16/SkyServerWS'):
-        self.base_url = base_url
+    def __init__(self, base_url=None, cache=None):
+        self.base_url = base_url or os.environ.get('ASTROMLP_SKYSERVER_URL', 'http://skyserver.sdss.org/dr16/SkyServerWS')
+        self.cache = cache
 
     def _url(self, action):
         return f"{ self.base_url}{ action }"
@@ -24,33 +29,90 @@ class SkyServer:
             Returns:
                 a `Dict` containing proprieties available for the object from the `sdss-ds`
         """
-        obj = None
+        return self.get_objs([objid], wise=wise)[0]
 
-        # SpecPhoto data
-        sql = f"SELECT objID as objid, mjd, plate, tile, fiberID as fiberid, run, rerun, camcol, field, ra, dec, class, subClass as subclass, modelMag_u, modelMag_g, modelMag_r, modelMag_i, modelMag_z, z as redshift FROM SpecPhoto WHERE objID={ str(objid) } AND class='GALAXY' AND subClass is not null AND zwarning=0"
-        payload = { 'cmd': sql, 'format': 'json' }
-        r = requests.get(self._url('/SearchTools/SqlSearch'), params=payload)
-        if r.status_code == 200:
-            data = r.json()
-            if len(data) == 2 and 'Rows' in data[0] and len(data[0]['Rows']) == 1:
-                obj = data[0]['Rows'][0]
+    def _objs_sql(self, objids, wise):
+        # SpecPhoto data, and WISE_allsky data in the same query
+        cols = "s.objID as objid, s.mjd, s.plate, s.tile, s.fiberID as fiberid, s.run, s.rerun, s.camcol, s.field, s.ra, s.dec, s.class, s.subClass as subclass, s.modelMag_u, s.modelMag_g, s.modelMag_r, s.modelMag_i, s.modelMag_z, s.z as redshift"
+        joins = ""
+        if wise:
+            cols += ", w.w1mag, w.w2mag, w.w3mag, w.w4mag"
+            joins = " LEFT JOIN WISE_xmatch x ON x.sdss_objid = s.objID LEFT JOIN WISE_allsky w ON x.wise_cntr = w.cntr"
 
-        if not wise:
-            return obj
+        ids = ", ".join([str(int(x)) for x in objids])
 
-        # WISE_allsky data
-        sql = f"SELECT s.objID, w.w1mag, w.w2mag, w.w3mag, w.w4mag FROM SpecPhoto s JOIN WISE_xmatch x ON x.sdss_objid = s.objID JOIN WISE_allsky w ON x.wise_cntr = w.cntr WHERE s.objID={ str(objid) }"
-        payload = { 'cmd': sql, 'format': 'json' }
-        r = requests.get(self._url('/SearchTools/SqlSearch'), params=payload)
-        if r.status_code == 200:
-            data = r.json()
-            if len(data) == 2 and 'Rows' in data[0] and len(data[0]['Rows']) == 1 and len(data[0]['Rows'][0]) == 5:
-                obj['w1mag'] = data[0]['Rows'][0]['w1mag']
-                obj['w2mag'] = data[0]['Rows'][0]['w2mag']
-                obj['w3mag'] = data[0]['Rows'][0]['w3mag']
-                obj['w4mag'] = data[0]['Rows'][0]['w4mag']
+        return f"SELECT { cols } FROM SpecPhoto s{ joins } WHERE s.objID IN ({ ids }) AND s.class='GALAXY' AND s.subClass is not null AND s.zwarning=0"
 
-        return obj
+    def get_objs(self, objids, wise=True, chunk_size=200):
+        """ Retrieve information for a list of SDSS objects, using one query per chunk of objects.
+            Queries are sent in the body of a POST request, a chunk of 200 identifiers is a query of
+            about 5 KB that would exceed the query string limits of the SkyServer web server.
+
+            Args:
+                objids ([int]): list of SDSS object identifiers
+                wise (bool): include WISE data, defaults to `True`
+                chunk_size (int): number of objects per query, defaults to `200`
+            Returns:
+                a list of `Dict` containing proprieties available for each object, in the same order
+                as `objids`, `None` for objects not found
+        """
+        objids = [int(x) for x in objids]
+        _unique = list(dict.fromkeys(objids))
+
+        found = {}
+        if self.cache is not None:
+            found = self.cache.get_many(_unique, wise=wise)
+            _unique = [x for x in _unique if x not in found]
+
+        for start in range(0, len(_unique), chunk_size):
+            chunk = _unique[start:start+chunk_size]
+            payload = { 'cmd': self._objs_sql(chunk, wise), 'format': 'json' }
+            r = httpclient.post(self._url('/SearchTools/SqlSearch'), data=payload)
+            if r.status_code != 200:
+                logger.warn(f'SkyServer request failed { r.status_code }')
+                continue
+
+            _found = self._parse_objs(r.json(), wise)
+            if _found is not None:
+                found.update(_found)
+                self._cache_objs(chunk, _found, wise)
+
+        return [found.get(x) for x in objids]
+
+    def _cache_objs(self, objids, found, wise):
+        # objects missing from a successful query are cached as not found
+        if self.cache is not None:
+            self.cache.put_many(dict([(x, found.get(x)) for x in objids]), wise=wise)
+
+    def _parse_objs(self, data, wise):
+        # objects found by identifier, or `None` if the response is not valid
+        found = None
+
+        if len(data) == 2 and 'Rows' in data[0]:
+            found = {}
+            rows = {}
+            for row in data[0]['Rows']:
+                rows.setdefault(int(row['objid']), []).append(row)
+
+            for objid, _rows in rows.items():
+                obj = _rows[0]
+                # WISE data only if there is a single match
+                if wise and (len(_rows) > 1 or obj['w1mag'] is None):
+                    for k in ['w1mag', 'w2mag', 'w3mag', 'w4mag']:
+                        obj.pop(k, None)
+                found[objid] = obj
+
+        return found
+
+    def _jpeg_payload(self, ra, dec, scale, width, height):
+        return {
+            'ra': ra,
+            'dec': dec,
+            'scale': scale,
+            'width': width,
+            'height': height,
+            'opt': ''
+        }
 
     def save_jpeg(self, objid, filename, ra=None, dec=None, scale=0.2, width=150, height=150):
         """ Save RGB image in JPEG format for a given SDSS object identifier.
@@ -68,8 +130,6 @@ class SkyServer:
         if os.path.exists(filename):
             return filename
 
-        url = 'http://skyserver.sdss.org/dr17/SkyServerWS/ImgCutout/getjpeg'
-
         if ra is None or dec is None:
             obj = self.get_obj(objid)
             if obj is None:
@@ -77,18 +137,12 @@ class SkyServer:
             else:
                 ra, dec = obj['ra'], obj['dec']
 
-        payload = {
-            'ra': ra,
-            'dec': dec,
-            'scale': scale,
-            'width': width,
-            'height': height,
-            'opt': ''
-        }
-        r = requests.get(self._url('/ImgCutout/getjpeg'), params=payload)
+        payload = self._jpeg_payload(ra, dec, scale, width, height)
+        r = httpclient.get(self._url('/ImgCutout/getjpeg'), params=payload)
 
         if r.status_code == 200:
-            with open(filename, 'wb') as fout:
-                fout.write(r.content)
+            atomic_write(filename, r.content)
+        else:
+            return None
 
         return filename
\ No newline at end of file
@@ -0,0 +1,173 @@
+
+import os, logging
+import numpy as np
+from pandas import Index
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+class ArrayStore:
+    """ A store of fixed-width arrays, one row per SDSS object, packed into a single
+        memory-mapped numpy file and indexed by SDSS object identifier.
+
+        Attributes:
+            path (str): location of the store directory
+    """
+    def __init__(self, path):
+        """ Constructor method """
+        self.path = path
+
+        self.ids = np.load(os.path.join(self.path, 'ids.npy'))
+        self.data = np.load(os.path.join(self.path, 'data.npy'), mmap_mode='r')
+        self._index = Index(self.ids)
+        self._aux = {}
+
+    @staticmethod
+    def exists(path):
+        """ Check if a store is available in a given location.
+
+            Args:
+                path (str): location of the store directory
+            Returns:
+                `True` if the store exists
+        """
+        # the index is written last, so a partially built store is never used
+        return os.path.exists(os.path.join(path, 'ids.npy'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, objid):
+        return int(objid) in self._index
+
+    @property
+    def shape(self):
+        return self.data.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def positions(self, ids):
+        """ Rows in the store for a list of SDSS object identifiers.
+
+            Args:
+                ids ([int]): list of SDSS object identifiers
+            Returns:
+                a numpy array of rows, `-1` for objects not in the store
+        """
+        return self._index.get_indexer(np.asarray(ids).astype(np.int64))
+
+    def row(self, objid):
+        """ Data for a single SDSS object, as a read-only view on the store.
+
+            Args:
+                objid (int): SDSS object identifier
+            Returns:
+                a numpy array
+        """
+        return self.data[self._index.get_loc(int(objid))]
+
+    def take(self, positions):
+        """ Data for a list of rows, a view on the store if the rows are contiguous.
+
+            Args:
+                positions ([int]): list of rows
+            Returns:
+                a numpy array
+        """
+        positions = np.asarray(positions)
+        if len(positions) > 0 and positions[0] >= 0 and np.array_equal(positions, np.arange(positions[0], positions[0] + len(positions))):
+            return self.data[positions[0]:positions[0] + len(positions)]
+
+        return self.data[positions]
+
+    def get(self, ids):
+        """ Data for a list of SDSS object identifiers.
+
+            Args:
+                ids ([int]): list of SDSS object identifiers
+            Returns:
+                a numpy array
+        """
+        positions = self.positions(ids)
+        if (positions < 0).any():
+            raise KeyError(f'Objects not in store { self.path }: { np.asarray(ids)[positions < 0].tolist() }')
+
+        return self.take(positions)
+
+    def aux(self, name):
+        """ Auxiliary array saved with the store (eg. `waves`).
+
+            Args:
+                name (str): auxiliary array name
+            Returns:
+                a numpy array
+        """
+        if name not in self._aux:
+            self._aux[name] = np.load(os.path.join(self.path, f'{ name }.npy'))
+
+        return self._aux[name]
+
+    @classmethod
+    def build(cls, path, ids, load, shape, dtype=np.float32, aux={}, workers=8):
+        """ Build a store given a list of SDSS object identifiers and a function to load
+            the data for each object, objects for which the function returns `None` are skipped.
+
+            Args:
+                path (str): location of the store directory
+                ids ([int]): list of SDSS object identifiers
+                load (callable): function returning the data for an identifier, or `None`
+                shape (tuple): shape of the data for a single object
+                dtype: data type for the store, defaults to `float32`
+                aux (dict): auxiliary arrays to save with the store
+                workers (int): number of threads used to load the data, defaults to `8`
+            Returns:
+                an `ArrayStore`
+        """
+        ids = list(dict.fromkeys(int(x) for x in ids))
+        os.makedirs(path, exist_ok=True)
+        _ids_filename = os.path.join(path, 'ids.npy')
+        if os.path.exists(_ids_filename):
+            os.remove(_ids_filename)
+
+        _data_filename = os.path.join(path, 'data.npy')
+        _tmp_filename = os.path.join(path, 'data.tmp.npy')
+        data = np.lib.format.open_memmap(_tmp_filename, mode='w+', dtype=dtype, shape=(len(ids),) + tuple(shape))
+
+        kept = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for i, x in zip(ids, executor.map(load, ids)):
+                if x is None:
+                    continue
+                if np.shape(x) != tuple(shape):
+                    logger.warn(f'Err shape { i } - { np.shape(x) }')
+                    continue
+                data[len(kept)] = x
+                kept.append(i)
+
+        data.flush()
+
+        # skipped objects leave rows unused at the end, copy the rows kept to a file of the final size
+        if len(kept) == 0:
+            del data
+            np.save(_data_filename, np.zeros((0,) + tuple(shape), dtype=dtype))
+            os.remove(_tmp_filename)
+        elif len(kept) < len(ids):
+            final = np.lib.format.open_memmap(_data_filename, mode='w+', dtype=dtype, shape=(len(kept),) + tuple(shape))
+            for start in range(0, len(kept), 4096):
+                final[start:start+4096] = data[start:start+4096]
+            final.flush()
+            del final, data
+            os.remove(_tmp_filename)
+        else:
+            del data
+            os.replace(_tmp_filename, _data_filename)
+
+        for k, v in aux.items():
+            np.save(os.path.join(path, f'{ k }.npy'), v)
+        np.save(_ids_filename, np.array(kept, dtype=np.int64))
+
+        logger.info(f'Store { path } built with { len(kept) } of { len(ids) } objects')
+
+        return cls(path)
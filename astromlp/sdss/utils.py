@@ -51,6 +51,27 @@ def build_datagens(ids, x=None, y=None, batch_size=32, helper=None):
 
     return train_gen, val_gen, test_gen
 
+def build_datasets(ids, x=None, y=None, batch_size=32, helper=None, cache=None):
+    """ Build a `tf.data.Dataset` pipeline for a training, validation and test sets.
+
+        Args:
+            ids ([int]): a list of SDSS object identifiers
+            x ([str]): list of input variables (eg. `img`, `spectra`)
+            y ([str]): list of output variables (eg. `redshift`, `subclass`)
+            batch_size (int): batch size, defaults to `32`
+            cache (str): cache batches after the first epoch, `'memory'` or a filename prefix, defaults to `None`
+        Returns:
+            a tuple of datasets
+    """
+    train_gen, val_gen, test_gen = build_datagens(ids, x=x, y=y, batch_size=batch_size, helper=helper)
+
+    datasets = []
+    for name, gen in [('train', train_gen), ('val', val_gen), ('test', test_gen)]:
+        _cache = cache if cache in [None, 'memory'] else f'{ cache }_{ name }'
+        datasets.append(gen.to_dataset(shuffle=(name == 'train'), cache=_cache))
+
+    return tuple(datasets)
+
 def history_save(name, history, base_dir='./model_history'):
     """ Save model history given a tensorflow history object.
 
@@ -0,0 +1,211 @@
+
+import os, io, re, bz2, json, sys, time, sqlite3, signal, shutil, tempfile, threading, subprocess, unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# four galaxies, the first two in the same field
+OBJS = [
+    { 'objid': 1237648720693755001, 'ra': 180.0, 'dec': 10.0, 'field': 11, 'fiberid': 1 },
+    { 'objid': 1237648720693755002, 'ra': 180.002, 'dec': 10.001, 'field': 11, 'fiberid': 2 },
+    { 'objid': 1237648720693755003, 'ra': 181.0, 'dec': 11.0, 'field': 12, 'fiberid': 3 },
+    { 'objid': 1237648720693755004, 'ra': 182.0, 'dec': 12.0, 'field': 13, 'fiberid': 4 }
+]
+for obj in OBJS:
+    obj.update({ 'run': 756, 'rerun': 301, 'camcol': 1, 'plate': 266, 'mjd': 51630, 'tile': 145, 'class': 'GALAXY',
+                 'subclass': 'STARFORMING', 'modelMag_u': 19.1, 'modelMag_g': 17.9, 'modelMag_r': 17.2,
+                 'modelMag_i': 16.8, 'modelMag_z': 16.5, 'redshift': 0.05 })
+
+JPEG = b'\xff\xd8\xff\xe0' + b'\x00' * 128 + b'\xff\xd9'
+
+def _frame(field):
+    # frame centred on the first object of the field, with SDSS pixel scale
+    obj = [x for x in OBJS if x['field'] == field][0]
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [obj['ra'], obj['dec']]
+    wcs.wcs.crpix = [200, 200]
+    wcs.wcs.cdelt = [-0.396 / 3600, 0.396 / 3600]
+
+    buf = io.BytesIO()
+    data = np.random.default_rng(field).random((400, 400)).astype(np.float32)
+    fits.PrimaryHDU(data, header=wcs.to_header()).writeto(buf)
+
+    return bz2.compress(buf.getvalue())
+
+def _spectra():
+    # 3522 wavelengths in the range used by the models, and a few outside
+    waves = np.concatenate([[3850.0, 3900.0], np.linspace(4000, 9000, 3522), [9100.0, 9200.0]])
+    lines = ['Wavelength,Flux,BestFit,SkyFlux'] + [f'{ w },{ 1.0 },{ 1.0 + w / 1e4 },{ 0.1 }' for w in waves]
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+class StandIn(BaseHTTPRequestHandler):
+    """ Local stand-in for the SkyServer, SAS frames and spectra services. """
+    requests = {}
+    blocked = set()
+    release = threading.Event()
+
+    def log_message(self, *args):
+        pass
+
+    def _count(self):
+        StandIn.requests[self.path] = StandIn.requests.get(self.path, 0) + 1
+
+    def _send(self, content, status=200):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        self._count()
+        if urlparse(self.path).path != '/SkyServerWS/SearchTools/SqlSearch':
+            return self._send(b'', status=404)
+
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        ids = [int(x) for x in re.search(r'IN \(([\d, ]+)\)', form['cmd'][0]).group(1).split(',')]
+        rows = [obj for obj in OBJS if obj['objid'] in ids]
+
+        self._send(json.dumps([{ 'TableName': 'Table1', 'Rows': rows }, { 'TableName': 'Table2', 'Rows': [] }]).encode('utf-8'))
+
+    def do_GET(self):
+        self._count()
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/SkyServerWS/ImgCutout/getjpeg':
+            if float(query['ra'][0]) in StandIn.blocked:
+                StandIn.release.wait(timeout=60)
+            return self._send(JPEG)
+        if url.path == '/spectra':
+            return self._send(_spectra())
+        m = re.match(r'/frames/301/756/1/frame-[ugriz]-000756-1-(\d{4})\.fits\.bz2$', url.path)
+        if m:
+            return self._send(_frame(int(m.group(1))))
+
+        self._send(b'', status=404)
+
+class TestIngest(unittest.TestCase):
+
+    def setUp(self):
+        StandIn.requests = {}
+        StandIn.blocked = set()
+        StandIn.release = threading.Event()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{ self.server.server_address[1] }'
+
+        self.tmp = tempfile.mkdtemp()
+        self.ds = os.path.join(self.tmp, 'sdss-gs')
+        self.env = {
+            'ASTROMLP_SKYSERVER_URL': f'{ base }/SkyServerWS',
+            'ASTROMLP_FRAMES_URL': f'{ base }/frames',
+            'ASTROMLP_SPECTRA_URL': f'{ base }/spectra',
+            'ASTROMLP_FRAMES_DIR': os.path.join(self.tmp, 'frames')
+        }
+        self._environ = dict(os.environ)
+        os.environ.update(self.env)
+
+    def tearDown(self):
+        StandIn.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _helper(self):
+        from astromlp.sdss.helper import Helper
+
+        return Helper(self.ds)
+
+    def _journal_rows(self):
+        with sqlite3.connect(os.path.join(self.ds, 'ingest.sqlite')) as db:
+            return dict([((objid, m), (status, attempts)) for objid, m, status, attempts in db.execute('SELECT objid, modality, status, attempts FROM state')])
+
+    def test_ingest_resume_processes(self):
+        from astromlp.sdss.ingest import ingest, Journal
+
+        helper = self._helper()
+        journal = Journal(os.path.join(self.ds, 'ingest.sqlite'))
+        ids = [obj['objid'] for obj in OBJS]
+
+        report = ingest(ids[:2], helper=helper, journal=journal, processes=0, threads=2)
+        self.assertEqual(report['objects'], 2)
+        for m in ['img', 'fits', 'spectra', 'ssel']:
+            self.assertEqual(report['modalities'][m]['done'], 2)
+            self.assertEqual(report['modalities'][m]['failed'], 0)
+        self.assertGreater(report['bytes'], 0)
+
+        # only the objects not ingested yet are processed again
+        report = ingest(ids, helper=helper, journal=journal, processes=2, threads=2, chunk_size=1)
+        self.assertEqual(report['objects'], 2)
+        self.assertEqual(report['modalities']['fits']['done'], 2)
+
+        for objid in ids:
+            with open(helper._img_filename(objid), 'rb') as fin:
+                self.assertEqual(fin.read(), JPEG)
+            self.assertEqual(np.load(helper._fits_filename(objid)).shape, (61, 61, 5))
+            self.assertTrue(os.path.exists(helper._spectra_filename(objid)))
+            self.assertTrue(os.path.exists(helper._ssel_filename(objid)))
+            self.assertEqual(helper.load_spectra(helper._spectra_filename(objid))[0].shape, (3522,))
+
+        self.assertTrue(all(status == 'done' and attempts == 1 for status, attempts in self._journal_rows().values()))
+        self.assertEqual(len(self._journal_rows()), 4 * 4)
+
+        # frames are shared by objects in the same field, and downloaded once
+        frames = [(p, n) for p, n in StandIn.requests.items() if p.startswith('/frames/')]
+        self.assertEqual(len(frames), 3 * 5)
+        self.assertTrue(all(n == 1 for _, n in frames))
+
+    def test_ingest_killed_resume(self):
+        from astromlp.sdss.ingest import ingest, Journal
+
+        ids = [obj['objid'] for obj in OBJS[:2]]
+        ids_filename = os.path.join(self.tmp, 'ids.txt')
+        with open(ids_filename, 'w') as fout:
+            fout.write('\n'.join(str(x) for x in ids))
+
+        # the second object hangs until the ingestion is killed
+        StandIn.blocked.add(OBJS[1]['ra'])
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        proc = subprocess.Popen([sys.executable, '-m', 'astromlp.sdss.ingest', ids_filename, '--ds', self.ds, '--x', 'img', 'spectra',
+                                 '--processes', '0', '--threads', '1', '--chunk-size', '1'], cwd=ROOT, env=env)
+        try:
+            deadline = time.time() + 120
+            while time.time() < deadline:
+                if os.path.exists(os.path.join(self.ds, 'ingest.sqlite')):
+                    rows = self._journal_rows()
+                    if rows.get((ids[0], 'img'), (None,))[0] == 'done' and rows.get((ids[0], 'spectra'), (None,))[0] == 'done':
+                        break
+                self.assertIsNone(proc.poll())
+                time.sleep(0.2)
+            proc.send_signal(signal.SIGKILL)
+        finally:
+            proc.wait()
+            StandIn.release.set()
+
+        rows = self._journal_rows()
+        self.assertEqual(rows[(ids[0], 'img')], ('done', 1))
+        self.assertNotIn((ids[1], 'img'), rows)
+
+        helper = self._helper()
+        report = ingest(ids, helper=helper, journal=Journal(os.path.join(self.ds, 'ingest.sqlite')), x=['img', 'spectra'], processes=0)
+        self.assertEqual(report['objects'], 1)
+        self.assertEqual(report['modalities']['img'], { 'done': 1, 'failed': 0, 'bytes': len(JPEG) })
+
+        rows = self._journal_rows()
+        self.assertEqual(rows[(ids[0], 'img')], ('done', 1))
+        self.assertEqual(rows[(ids[1], 'img')], ('done', 1))
+        for objid in ids:
+            self.assertTrue(os.path.exists(helper._img_filename(objid)))
+            self.assertTrue(os.path.exists(helper._spectra_filename(objid)))
+
+if __name__ == '__main__':
+    unittest.main()